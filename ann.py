@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import torch
+from test import get_csr_is_hit
+
+
+def fuse_views(features):
+    '''
+    float32 [n, sum of d]: the views (e.g. atom, non-atom) of `features` side by side,
+    the inner product of two fused vectors is the sum of the inner products of their views
+    '''
+    return np.concatenate([np.asarray(f, dtype=np.float32) for f in features], axis=1)
+
+
+class IVFIndex(object):
+    '''
+    inverted-file index for maximum inner product search over the rows of `vectors` [n, d]
+    the rows are clustered into `nlist` lists by k-means with L2 assignment (inner-product assignment
+    drains the lists towards the centroids of large norm), a query scores the centroids and then only
+    the rows of its `nprobe` best lists: `nprobe` trades recall for latency at search time,
+    `nprobe` = `nlist` is the exact search
+    the lists are stored CSR-style: the rows of list i are `ids[offsets[i]:offsets[i + 1]]`
+    '''
+
+    def __init__(self, vectors, nlist, niter=10, seed=123, device=torch.device('cpu'), block=65536):
+        self.device = device
+        self.block = block
+        vectors = torch.as_tensor(np.asarray(vectors, dtype=np.float32)).to(device)
+        n = vectors.shape[0]
+        self.nlist = nlist = min(nlist, n)
+        generator = torch.Generator().manual_seed(seed)
+        centroids = vectors[torch.randperm(n, generator=generator)[:nlist].to(device)].clone()
+        for _ in range(niter):
+            assign = self._assign(vectors, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, vectors)
+            counts = torch.bincount(assign, minlength=nlist)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).float()
+        assign = self._assign(vectors, centroids)
+        counts = torch.bincount(assign, minlength=nlist)
+        self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        self.ids = torch.argsort(assign)
+        self.vectors = vectors
+        self.centroids = centroids
+
+    def _assign(self, vectors, centroids):
+        # nearest centroid in L2: argmax of x.c - |c|^2 / 2
+        bias = (centroids * centroids).sum(dim=1) / 2
+        return torch.cat([torch.argmax(vectors[start:start + self.block] @ centroids.t() - bias, dim=1)
+                          for start in range(0, vectors.shape[0], self.block)])
+
+    @property
+    def longest(self):
+        return int((self.offsets[1:] - self.offsets[:-1]).max())
+
+    def search(self, queries, topk, nprobe, exclude=None, chunk=16):
+        '''
+        the `topk` rows of the largest inner product with each of `queries` [q, d], best first,
+        as (scores, ids) [q, `topk`], ids are -1 where the probed lists hold fewer rows
+        `exclude`: (query, id) LongTensors of the pairs left out, e.g. `test.csr_nonzeros` of train interactions
+        `chunk`: queries scored at a time, only the rows of their probed lists are gathered
+        '''
+        queries = torch.as_tensor(queries, dtype=torch.float).to(self.device)
+        nprobe = min(nprobe, self.nlist)
+        _, probe = torch.topk(queries @ self.centroids.t(), nprobe)
+        all_scores, all_ids = [], []
+        for start in range(0, queries.shape[0], chunk):
+            end = min(start + chunk, queries.shape[0])
+            # the probed lists of the chunk flattened into one run of candidates
+            lists = probe[start:end].reshape(-1)
+            lengths = self.offsets[lists + 1] - self.offsets[lists]
+            pair = torch.repeat_interleave(torch.arange(lists.shape[0], device=self.device), lengths)
+            position = torch.arange(pair.shape[0], device=self.device) \
+                       - (lengths.cumsum(0) - lengths)[pair] + self.offsets[lists][pair]
+            flat_ids = self.ids[position]
+            query = pair // nprobe
+            flat_scores = (self.vectors[flat_ids] * queries[start:end][query]).sum(dim=1)
+            # left-aligned in [batch, most candidates of a query], -inf / -1 pad the rest
+            num_candidates = lengths.view(end - start, nprobe).sum(dim=1)
+            slot = torch.arange(pair.shape[0], device=self.device) - (num_candidates.cumsum(0) - num_candidates)[query]
+            width = max(int(num_candidates.max()), 1)
+            scores = torch.full((end - start, width), -float('inf'), device=self.device)
+            candidates = torch.full((end - start, width), -1, dtype=torch.long, device=self.device)
+            scores[query, slot] = flat_scores
+            candidates[query, slot] = flat_ids
+            if exclude is not None:
+                row, col = exclude
+                inside = (row >= start) & (row < end)
+                seen = get_csr_is_hit(candidates, row[inside] - start, col[inside], self.vectors.shape[0]) > 0
+                scores.masked_fill_(seen, -float('inf'))
+            scores, col = torch.topk(scores, min(topk, scores.shape[1]))
+            ids = candidates.gather(1, col)
+            ids.masked_fill_(scores == -float('inf'), -1)
+            all_scores.append(scores)
+            all_ids.append(ids)
+        return torch.cat(all_scores), torch.cat(all_ids)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import torch
+import numpy as np
+import dataset
+from ann import IVFIndex, fuse_views
+from export import EmbeddingStore
+from metric import MetricEngine, Recall, NDCG
+from snapshot import SnapshotScorer
+from config import CONFIG
+from test import csr_nonzeros, topk_bundles, get_csr_is_hit
+from time import time
+
+TOPK = 20
+NPROBES = [1, 2, 4, 8, 16, 32]
+
+
+def main():
+    '''
+    python bench_ann.py [nlist], the latest export of `CONFIG['dataset_name']` (see export.py)
+
+    per `NPROBES`: recall of the exact top-`TOPK` of the test users, Recall@`TOPK` and NDCG@`TOPK`
+    of the test split and search time of the IVF index against the exact search, both excluding
+    the train interactions
+    '''
+    os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    store = EmbeddingStore(os.path.join(CONFIG['export'], CONFIG['dataset_name']))
+    users_vector = torch.from_numpy(fuse_views(store.users_feature)).to(device)
+    bundles_vector = fuse_views(store.bundles_feature)
+    nlist = int(sys.argv[1]) if len(sys.argv) > 1 else int(4 * np.sqrt(store.num_bundles))
+    start = time()
+    index = IVFIndex(bundles_vector, nlist, device=device)
+    print('IVF: {} bundles in {} lists (longest {}), built in {:.2f}s'.format(
+        store.num_bundles, index.nlist, index.longest, time() - start))
+
+    session = dataset.DatasetSession(CONFIG['path'], CONFIG['dataset_name'])
+    loader = dataset.get_test_loader(session.get_test_dataset(CONFIG['eval_task']), CONFIG['batch_size_test'])
+    scorer = SnapshotScorer([torch.from_numpy(np.asarray(f, dtype=np.float32)) for f in store.users_feature],
+                            [torch.from_numpy(np.asarray(f, dtype=np.float32)) for f in store.bundles_feature],
+                            device)
+    rs = scorer.propagate()
+
+    rows = []
+    for nprobe in [None] + NPROBES:
+        metrics = [Recall(TOPK), NDCG(TOPK)]
+        engine = MetricEngine(metrics)
+        engine.start()
+        cost, overlap, num_users = 0, 0, 0
+        with torch.no_grad():
+            for users, ground_truth_u_b, train_mask_u_b in loader:
+                users = users.to(device)
+                ground_truth_row, ground_truth_col, num_pos = csr_nonzeros(*ground_truth_u_b, device)
+                train_row, train_col, _ = csr_nonzeros(*train_mask_u_b, device)
+                start = time()
+                exact = topk_bundles(scorer, rs, users, train_row, train_col, TOPK, CONFIG['eval_block'])
+                if nprobe is None:
+                    top_bundles = exact
+                else:
+                    start = time()
+                    _, top_bundles = index.search(users_vector[users], TOPK, nprobe, exclude=(train_row, train_col))
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                cost += time() - start
+                valid = (top_bundles >= 0).float()
+                exact_row = torch.arange(exact.shape[0], device=device).repeat_interleave(exact.shape[1])
+                overlap += (get_csr_is_hit(top_bundles, exact_row, exact.view(-1), store.num_bundles) * valid).sum().item()
+                num_users += users.shape[0]
+                engine(get_csr_is_hit(top_bundles, ground_truth_row, ground_truth_col, store.num_bundles) * valid, num_pos)
+        engine.stop()
+        rows.append((nprobe, overlap / (num_users * TOPK), metrics[0].metric, metrics[1].metric,
+                     1000 * cost / num_users))
+
+    exact_ms = rows[0][4]
+    print('nprobe\trecall vs exact@{0}\tRecall@{0}\tNDCG@{0}\tms/user\tspeedup'.format(TOPK))
+    for nprobe, overlap, recall, ndcg, ms in rows:
+        print('{}\t{:.4f}\t{:.5f}\t{:.5f}\t{:.4f}\t{:.2f}x'.format(
+            'exact' if nprobe is None else nprobe, overlap, recall, ndcg, ms, exact_ms / ms))
+
+
+if __name__ == "__main__":
+    main()
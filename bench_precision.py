@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import torch
+import dataset
+from model import load_MIDGN
+from metric import Recall, NDCG
+from config import CONFIG
+from test import test
+from time import time
+
+def run(model, precision, loader, device):
+    '''
+    time one `test` pass of `model` with the score GEMMs in `precision`
+    return (time of test, Recall@20, NDCG@20, scores of the first 256 users)
+    '''
+    model.precision = precision
+    model.eval()
+    metrics = [Recall(20), NDCG(20)]
+    start = time()
+    test(model, loader, device, CONFIG, metrics)
+    test_time = time() - start
+    with torch.no_grad():
+        scores = model.evaluate(model.propagate(), torch.arange(min(256, model.num_users), device=device))
+    return test_time, metrics[0].metric, metrics[1].metric, scores
+
+
+def main():
+    '''
+    python bench_precision.py [checkpoint], a randomly initialized model if no checkpoint is given
+    '''
+    os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    session = dataset.DatasetSession(CONFIG['path'], CONFIG['dataset_name'])
+    loader = dataset.get_test_loader(session.get_test_dataset(CONFIG['eval_task']), CONFIG['batch_size_test'])
+    model = load_MIDGN(session, device, sys.argv[1] if len(sys.argv) > 1 else None)
+    if device.type != 'cuda':
+        print('bf16 scoring only runs on CUDA, both passes below are float32')
+
+    fp32 = run(model, 'fp32', loader, device)
+    bf16 = run(model, 'bf16', loader, device)
+
+    score_diff = (fp32[3] - bf16[3]).abs().max().item()
+    print('test fp32: {:.3f}s\tbf16: {:.3f}s\tspeedup: {:.2f}x'.format(fp32[0], bf16[0], fp32[0] / bf16[0]))
+    print('Recall@20 fp32: {:.5f}\tbf16: {:.5f}\tdiff: {:+.5f}'.format(fp32[1], bf16[1], bf16[1] - fp32[1]))
+    print('NDCG@20 fp32: {:.5f}\tbf16: {:.5f}\tdiff: {:+.5f}'.format(fp32[2], bf16[2], bf16[2] - fp32[2]))
+    print('max abs diff of scores: {:.3e}'.format(score_diff))
+
+
+if __name__ == "__main__":
+    main()
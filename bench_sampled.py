@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import torch
+import dataset
+from model import load_MIDGN
+from metric import Recall, NDCG
+from config import CONFIG
+from test import test
+from time import time
+
+TOPKS = [10, 20, 40, 80]
+NEGATIVES = [100, 500, 1000]
+
+
+def run(model, loader, device, sampled):
+    '''
+    one `test` pass of `model`, full ranking if `sampled` is None
+    return (time, {title: metric})
+    '''
+    metrics = [Recall(k) for k in TOPKS] + [NDCG(k) for k in TOPKS]
+    start = time()
+    test(model, loader, device, CONFIG, metrics, sampled=sampled)
+    return time() - start, {metric.get_title(): metric.metric for metric in metrics}
+
+
+def concordance(full, sampled):
+    '''
+    fraction of checkpoint pairs that `sampled` orders like `full`
+    '''
+    pairs = [(i, j) for i in range(len(full)) for j in range(i + 1, len(full))]
+    agree = sum((full[i] - full[j]) * (sampled[i] - sampled[j]) > 0 for i, j in pairs)
+    return agree / len(pairs)
+
+
+def main():
+    '''
+    python bench_sampled.py [checkpoint ...], a randomly initialized model if no checkpoint is given
+
+    calibration of the sampled validation (`CONFIG['eval_negatives']`): Recall@K/NDCG@K of the full
+    ranking against the sampled ranking with each of `NEGATIVES`, per checkpoint, and with several
+    checkpoints how often the sampled ranking orders them like the full one
+    '''
+    os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    session = dataset.DatasetSession(CONFIG['path'], CONFIG['dataset_name'])
+    loader = dataset.get_test_loader(session.get_test_dataset(CONFIG['task']), CONFIG['batch_size_test'])
+    model = load_MIDGN(session, device)
+
+    checkpoints = sys.argv[1:] or [None]
+    results = []
+    for checkpoint in checkpoints:
+        if checkpoint is not None:
+            model.load_state_dict(torch.load(checkpoint, map_location=device))
+        results.append([run(model, loader, device, sampled) for sampled in [None] + NEGATIVES])
+
+    for checkpoint, result in zip(checkpoints, results):
+        (full_time, full), sampled = result[0], result[1:]
+        print(checkpoint or 'random init')
+        print('full\t{:.2f}s\t'.format(full_time) + '\t'.join(
+            '{}:{:.5f}'.format(title, value) for title, value in full.items()))
+        for num_neg, (cost, metrics) in zip(NEGATIVES, sampled):
+            print('{} sampled\t{:.2f}s ({:.1f}x)\t'.format(num_neg, cost, full_time / cost) + '\t'.join(
+                '{}:{:.5f} ({:.2f}x)'.format(title, value, value / max(full[title], 1e-8))
+                for title, value in metrics.items()))
+    if len(checkpoints) > 1:
+        for i, num_neg in enumerate(NEGATIVES):
+            print('{} sampled, checkpoint pairs ordered like the full ranking\t'.format(num_neg) + '\t'.join(
+                '{}:{:.2f}'.format(title, concordance([r[0][1][title] for r in results],
+                                                      [r[i + 1][1][title] for r in results]))
+                for title in results[0][0][1]))
+
+
+if __name__ == "__main__":
+    main()
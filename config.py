@@ -19,23 +19,51 @@ CONFIG = {
     'decays': [4e-5],
 
     ## hard negative sample and further train
-    'sample': 'simple',
+    'sample': 'simple', # simple | hard | popularity | mixed
     'hard_window': [0.7, 1.0], # top 30%
     'hard_prob': [0.3, 0.3], # probability 0.8
+    'hard_workers': 4, # processes building the hard windows
+    'pop_alpha': 0.75, # popularity/mixed: P(bundle) ~ degree^alpha
+    'pop_prob': 0.5, # mixed: probability of a popularity draw, uniform otherwise
+    'neg_table': None, # dir of the epoch-ahead negative tables (e.g. '/dev/shm/MIDGN'), None: sample in DataLoader
     'conti_train': 'log/iFashion_sample/',
 
+    ## item-level BPR stage feeding MIDGN's `pretrain`, 0: off
+    'item_pretrain_epochs': 0,
+
     ## other settings
     'epochs': 50,
     'early': 20,
     'log_interval': 20,
     'test_interval': 5,
     'retry': 1,
+    'async_eval': False, # evaluate in a background process while training goes on, see `evaluator.AsyncEvaluator`
+
+    ## data-parallel training (gloo), see `distributed.launch`
+    'nproc_per_node': 1,
+    'nnodes': 1,
+    'node_rank': 0,
+    'master_addr': '127.0.0.1',
+    'master_port': 29500,
+    'partition': False, # with several processes: each rank holds the U-I/B-I/non-atom edges of its users and bundles, routing exchanges only the items shared by several ranks, user/bundle features are still gathered as dense tables
 
     ## test path
     'test':['log/iFashion'],
+    'export': './export', # export.py: root of the embedding stores, one per dataset
+    'serve_host': '127.0.0.1', # serve.py
+    'serve_port': 8080,
+    'serve_max_batch': 256, # requests answered by one GEMM
+    'serve_max_wait': 2, # ms a batch waits for more requests after its first one
+    'eval_workers': 4, # eval_main.py: processes evaluating the checkpoints on CPU
     'batch_size_train': 2048,
     'batch_size_test': 2048,
+    'eval_negatives': None, # e.g. 100: validation ranks the positives of a user against this many fixed sampled negatives (see bench_sampled.py), None: all bundles
+    'eval_block': 8192, # bundles scored at a time by `test`, which keeps a running top-K across the blocks
     'n_layers': 2,
+    'routing': 'batched', # intent routing: batched | loop
+    'precision': 'fp32', # fp32 | bf16: score GEMMs of evaluate in bfloat16 on CUDA, the SpMMs stay in float32
+    'propagate_every': 1, # batches sharing one propagate, their losses are backpropagated once
+    'subgraph_fanouts': None, # e.g. [20, 10, 10, 10]: per-batch subgraph training, fanout of the U-B/B-B hop then of each routing hop, None: full graph
     'corDecay': 1e-2,
     'topk_pos': 30,
     'topk_neg': 30,
@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import hashlib
+import multiprocessing
 import torch
 import numpy as np
 import scipy.sparse as sp 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
 from config import CONFIG
 
 
@@ -21,15 +24,252 @@ def to_tensor(graph):
                                           torch.Size(graph.shape))
     return graph
 
-def print_statistics(X, string):
+def get_statistics(X):
+    indptr, indices = X.indptr, X.indices
+    return {'average_interactions': float(X.data.sum())/X.shape[0],
+            'nonzero_rows': int(np.count_nonzero(np.diff(indptr))),
+            'nonzero_columns': int(np.unique(indices).shape[0]),
+            'nnz': int(X.nnz)}
+
+def print_statistics(X, string, stats=None):
+    if stats is None:
+        stats = get_statistics(X.tocsr())
     print('>'*10 + string + '>'*10 )
-    print('Average interactions', X.sum(1).mean(0).item())
-    nonzero_row_indice, nonzero_col_indice = X.nonzero()
-    unique_nonzero_row_indice = np.unique(nonzero_row_indice)
-    unique_nonzero_col_indice = np.unique(nonzero_col_indice)
-    print('Non-zero rows', len(unique_nonzero_row_indice)/X.shape[0])
-    print('Non-zero columns', len(unique_nonzero_col_indice)/X.shape[1])
-    print('Matrix density', len(nonzero_row_indice)/(X.shape[0]*X.shape[1]))
+    print('Average interactions', stats['average_interactions'])
+    print('Non-zero rows', stats['nonzero_rows']/X.shape[0])
+    print('Non-zero columns', stats['nonzero_columns']/X.shape[1])
+    print('Matrix density', stats['nnz']/(X.shape[0]*X.shape[1]))
+
+
+CACHE_VERSION = 1
+CACHE_DIR = '.cache'
+
+def file_checksum(filename, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _read_cache(cache_path, meta):
+    '''
+    return (`pairs`, `csr_matrix`, `stats`) memory-mapped from `cache_path`
+    or None if the cache is missing or stale
+    '''
+    try:
+        with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+            cached_meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(cached_meta.get(k) != v for k, v in meta.items()):
+        return None
+    arrays = {k: np.load(os.path.join(cache_path, '{}.npy'.format(k)), mmap_mode='c')
+              for k in ('pairs', 'indptr', 'indices', 'data')}
+    graph = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                          shape=tuple(meta['shape']))
+    return arrays['pairs'], graph, cached_meta['stats']
+
+def _write_cache(cache_path, meta, pairs, graph, stats):
+    '''
+    every file is written under a temporary name and renamed into place, so processes that
+    build the same cache at once never see, or memory-map, a partially written file
+    '''
+    os.makedirs(cache_path, exist_ok=True)
+    for k, v in (('pairs', pairs), ('indptr', graph.indptr),
+                 ('indices', graph.indices), ('data', graph.data)):
+        tmp = os.path.join(cache_path, '{}.{}.npy'.format(k, os.getpid()))
+        np.save(tmp, v)
+        os.replace(tmp, os.path.join(cache_path, '{}.npy'.format(k)))
+    # meta.json is written last, a cache without a valid header is rebuilt
+    tmp = os.path.join(cache_path, 'meta.json.{}'.format(os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(dict(meta, stats=stats), f)
+    os.replace(tmp, os.path.join(cache_path, 'meta.json'))
+
+def load_interaction(path, name, filename, shape):
+    '''
+    load a tab-separated `row\tcol` file of dataset `name` as
+    (`pairs`: int32 array [n, 2], `graph`: csr_matrix of `shape`, `stats`: dict)
+
+    the parsed result is kept in `<path>/<name>/.cache/<filename>/` as .npy files
+    with a `meta.json` header (sizes, statistics, checksum of the source file),
+    it is rebuilt whenever the source file changes
+    '''
+    source = os.path.join(path, name, filename)
+    cache_path = os.path.join(path, name, CACHE_DIR, os.path.splitext(filename)[0])
+    meta = {'version': CACHE_VERSION,
+            'source': filename,
+            'checksum': file_checksum(source),
+            'shape': list(shape)}
+    cached = _read_cache(cache_path, meta)
+    if cached is not None:
+        return cached
+
+    pairs = np.loadtxt(source, dtype=np.int32, delimiter='\t', ndmin=2)
+    values = np.ones(len(pairs), dtype=np.float32)
+    graph = sp.coo_matrix(
+        (values, (pairs[:, 0], pairs[:, 1])), shape=shape).tocsr()
+    stats = get_statistics(graph)
+    try:
+        _write_cache(cache_path, meta, pairs, graph, stats)
+    except OSError as e:
+        print('fail to write dataset cache {}: {}'.format(cache_path, e))
+    return pairs, graph, stats
+
+
+class PositiveIndex(object):
+    '''
+    vectorized `graph[rows, cols] != 0` lookups on a csr_matrix
+
+    every stored entry is flattened to `row * num_cols + col` (taken from `indptr`/`indices`),
+    a batch of queries is answered with one `np.searchsorted` over these keys
+    '''
+
+    def __init__(self, graph):
+        graph = graph.tocsr()
+        self.num_cols = graph.shape[1]
+        rows = np.repeat(np.arange(graph.shape[0], dtype=np.int64), np.diff(graph.indptr))
+        keys = (rows * self.num_cols + graph.indices)[graph.data != 0]
+        if np.any(keys[1:] < keys[:-1]):
+            keys = np.sort(keys)
+        self.keys = keys
+
+    def contains(self, rows, cols):
+        query = np.asarray(rows, dtype=np.int64) * self.num_cols + cols
+        if self.keys.shape[0] == 0:
+            return np.zeros(query.shape, dtype=bool)
+        pos = np.minimum(np.searchsorted(self.keys, query), self.keys.shape[0]-1)
+        return self.keys[pos] == query
+
+
+def sample_negatives(positive, rows, num_neg, draw, max_rounds=100, fallback=None):
+    '''
+    draw `num_neg` distinct negatives for each of `rows` in one shot,
+    then redraw only the collisions (positives of the row in `positive`, or duplicates in the row)
+    Args:
+    - `positive`: `PositiveIndex` of the interactions to exclude
+    - `rows`: int array [n], the row (user) of every sample
+    - `draw`: `draw(idx)` returns one candidate for each sample `idx` (int array, may repeat)
+    - `fallback`: `draw` used for collisions left after `max_rounds` rounds (default: `draw`)
+    return int64 array [n, `num_neg`]
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    negs = np.empty((rows.shape[0], num_neg), dtype=np.int64)
+    todo = np.ones(negs.shape, dtype=bool)
+    rounds = 0
+    while todo.any():
+        idx, col = np.nonzero(todo)
+        negs[idx, col] = draw(idx) if fallback is None or rounds < max_rounds else fallback(idx)
+        todo[idx, col] = positive.contains(rows[idx], negs[idx, col])
+        for j in range(1, num_neg):
+            todo[:, j] |= (negs[:, j:j+1] == negs[:, :j]).any(axis=1)
+        rounds += 1
+    return negs
+
+
+class AliasTable(object):
+    '''
+    Walker/Vose alias table, O(1) draws from the discrete distribution `weights`,
+    uniform if all `weights` are 0
+    '''
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = weights.shape[0]
+        total = weights.sum()
+        prob = weights * n / total if total > 0 else np.ones(n)
+        alias = np.arange(n, dtype=np.int64)
+        small = np.nonzero(prob < 1)[0]
+        large = np.nonzero(prob >= 1)[0]
+        # Vose's pairing, all the smalls of a round at once: laid end to end, each small takes as alias
+        # the large whose excess covers the start of its deficit, the larges left below 1 are the next smalls
+        while small.shape[0] and large.shape[0]:
+            deficit = 1 - prob[small]
+            excess = np.cumsum(prob[large] - 1)
+            owner = np.searchsorted(excess, np.cumsum(deficit) - deficit, side='right')
+            owner = np.minimum(owner, large.shape[0] - 1)
+            alias[small] = large[owner]
+            prob[large] -= np.bincount(owner, weights=deficit, minlength=large.shape[0])
+            small, large = large[prob[large] < 1], large[prob[large] >= 1]
+        prob[small] = 1
+        prob[large] = 1
+        self.prob = prob
+        self.alias = alias
+
+    def draw(self, size):
+        i = np.random.randint(self.prob.shape[0], size=size)
+        return np.where(np.random.uniform(0, 1, size=size) < self.prob[i], i, self.alias[i])
+
+
+HARD_BLOCK_SIZE = 1 << 24  # max number of dense scores held by one worker
+
+_hard_graphs = None
+
+def _init_hard_worker(A, B):
+    global _hard_graphs
+    _hard_graphs = (A, B)
+
+def _hard_block(args):
+    '''
+    candidates of rows [`start`, `stop`) of `A @ B.T`: the bundles whose ascending rank in the row
+    falls in [`lo`, `hi`), keeping only the ones with a positive score
+    '''
+    start, stop, lo, hi = args
+    A, B = _hard_graphs
+    scores = (A[start:stop] @ B.T).toarray()
+    kth = sorted({k for k in (lo, hi-1) if 0 <= k < scores.shape[1]})
+    window = np.argpartition(scores, kth, axis=1)[:, lo:hi]
+    keep = np.take_along_axis(scores, window, axis=1) > 0
+    return keep.sum(axis=1), window[keep].astype(np.int32)
+
+
+class HardCandidates(object):
+    '''
+    hard negative windows stored as an int32 CSR (`indptr`, `indices`)
+
+    only the candidates with a positive score are stored, a slot of the `width`-wide window
+    without one (a zero-score tie in the dense ranking) is drawn uniformly from all `num_cols`
+    '''
+
+    def __init__(self, indptr, indices, width, num_cols):
+        self.indptr = indptr
+        self.indices = indices
+        self.width = width
+        self.num_cols = num_cols
+
+    def draw(self, rows):
+        slots = np.random.randint(self.width, size=rows.shape[0])
+        candidates = np.random.randint(self.num_cols, size=rows.shape[0])
+        start = self.indptr[rows]
+        mask = slots < self.indptr[rows+1] - start
+        candidates[mask] = self.indices[start[mask] + slots[mask]]
+        return candidates
+
+
+def build_hard_candidates(A, B, window, processes=1):
+    '''
+    rank every row of `A @ B.T` and keep the `window` (fractions, ascending order) of it,
+    the product is built `HARD_BLOCK_SIZE` scores at a time with `np.argpartition`
+    instead of a dense product and a full sort
+    - `processes`: size of the process pool working on the row blocks
+    '''
+    A, B = A.tocsr(), B.tocsr()
+    num_rows, num_cols = A.shape[0], B.shape[0]
+    lo, hi = [int(i*num_cols) for i in window]
+    block = max(1, HARD_BLOCK_SIZE // max(num_cols, 1))
+    tasks = [(start, min(start+block, num_rows), lo, hi) for start in range(0, num_rows, block)]
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer=_init_hard_worker, initargs=(A, B)) as pool:
+            blocks = pool.map(_hard_block, tasks)
+    else:
+        _init_hard_worker(A, B)
+        blocks = [_hard_block(task) for task in tasks]
+        _init_hard_worker(None, None)
+    lengths = np.concatenate([b[0] for b in blocks]) if blocks else np.zeros(0, dtype=np.int64)
+    indptr = np.zeros(num_rows+1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.concatenate([b[1] for b in blocks]) if blocks else np.zeros(0, dtype=np.int32)
+    return HardCandidates(indptr, indices, hi-lo, num_cols)
 
 
 class BasicDataset(Dataset):
@@ -61,134 +301,268 @@ class BasicDataset(Dataset):
         with open(os.path.join(self.path, self.name, '{}_data_size.txt'.format(self.name)), 'r') as f:
             return [int(s) for s in f.readline().split('\t')][:3]
     def load_U_B_interaction(self):
-        with open(os.path.join(self.path, self.name, 'user_bundle_{}.txt'.format(self.task)), 'r') as f:
-            return list(map(lambda s: tuple(int(i) for i in s[:-1].split('\t')), f.readlines()))
+        return load_interaction(self.path, self.name, 'user_bundle_{}.txt'.format(self.task),
+                                (self.num_users, self.num_bundles))
     def load_U_I_interaction(self):
-        with open(os.path.join(self.path, self.name, 'user_item.txt'), 'r') as f:
-            return list(map(lambda s: tuple(int(i) for i in s[:-1].split('\t')), f.readlines()))
+        return load_interaction(self.path, self.name, 'user_item.txt',
+                                (self.num_users, self.num_items))
     def load_B_I_affiliation(self):
-        with open(os.path.join(self.path, self.name, 'bundle_item.txt'), 'r') as f:
-            return list(map(lambda s: tuple(int(i) for i in s[:-1].split('\t')), f.readlines()))
+        return load_interaction(self.path, self.name, 'bundle_item.txt',
+                                (self.num_bundles, self.num_items))
 
 
 class BundleTrainDataset(BasicDataset):
     def __init__(self, path, name, item_data, assist_data, seed=None):
         super().__init__(path, name, 'train', 1)
         # U-B
-        self.U_B_pairs = self.load_U_B_interaction()
-        indice = np.array(self.U_B_pairs, dtype=np.int32)
-        values = np.ones(len(self.U_B_pairs), dtype=np.float32)
-        self.ground_truth_u_b = sp.coo_matrix(
-            (values, (indice[:, 0], indice[:, 1])), shape=(self.num_users, self.num_bundles)).tocsr()
-
-        print_statistics(self.ground_truth_u_b, 'U-B statistics in train')
+        self.U_B_pairs, self.ground_truth_u_b, stats = self.load_U_B_interaction()
+        print_statistics(self.ground_truth_u_b, 'U-B statistics in train', stats)
+        self.positive_u_b = PositiveIndex(self.ground_truth_u_b)
 
         if CONFIG['sample'] == 'hard': 
+            processes = CONFIG['hard_workers']
             #  1. u_p --> b_n1
-            u_b_from_i = item_data.ground_truth_u_i @ assist_data.ground_truth_b_i.T
-            u_b_from_i = u_b_from_i.todense()
-            bn1_window = [int(i*self.num_bundles) for i in CONFIG['hard_window']]
-            self.u_b_for_neg_sample = np.argsort(u_b_from_i, axis=1)[:,bn1_window[0]:bn1_window[1]]
+            self.u_b_for_neg_sample = build_hard_candidates(
+                item_data.ground_truth_u_i, assist_data.ground_truth_b_i, CONFIG['hard_window'], processes)
 
             #  2. b_p --> b_n2
-            overlap_graph = assist_data.ground_truth_b_i @ assist_data.ground_truth_b_i.T
-            overlap_graph = overlap_graph.todense()
-            bn2_window = [int(i*self.num_bundles) for i in CONFIG['hard_window']]
-            self.b_b_for_neg_sample = np.argsort(overlap_graph, axis=1)[:,bn2_window[0]:bn2_window[1]]
-
-    def __getitem__(self, index):
-        user_b, pos_bundle = self.U_B_pairs[index]
-        all_bundles = [pos_bundle]
+            self.b_b_for_neg_sample = build_hard_candidates(
+                assist_data.ground_truth_b_i, assist_data.ground_truth_b_i, CONFIG['hard_window'], processes)
+            print('hard candidates: u-b {}, b-b {}'.format(
+                self.u_b_for_neg_sample.indices.shape[0], self.b_b_for_neg_sample.indices.shape[0]))
+        elif CONFIG['sample'] in ('popularity', 'mixed'):
+            # bundle degree in U-B train ^ alpha
+            degree = np.bincount(self.ground_truth_u_b.indices, minlength=self.num_bundles)
+            self.bundle_alias = AliasTable(degree ** CONFIG['pop_alpha'])
+
+    def sample(self, users, pos_bundles):
+        '''
+        draw `neg_sample` negatives for a batch of (`users`, `pos_bundles`) pairs
+        return int64 array [n, 1+`neg_sample`], column 0 is `pos_bundles`
+        '''
+        uniform = lambda idx: np.random.randint(self.num_bundles, size=idx.shape[0])
         if CONFIG['sample'] == 'simple':
-            while True:
-                i = np.random.randint(self.num_bundles)
-                if self.ground_truth_u_b[user_b, i] == 0 and not i in all_bundles:
-                    all_bundles.append(i)
-                    if len(all_bundles) == self.neg_sample+1:
-                        break
+            negs = sample_negatives(self.positive_u_b, users, self.neg_sample, uniform)
         elif CONFIG['sample'] == 'hard':
-            hard_probability = round(np.random.uniform(0, 1), 1)
-            if  hard_probability <= CONFIG['hard_prob'][0]:
-                while True:
-                    i = np.random.randint(self.u_b_for_neg_sample.shape[1])
-                    b_n1 = self.u_b_for_neg_sample[user_b, i]
-                    if self.ground_truth_u_b[user_b, b_n1] == 0 and not b_n1 in all_bundles:
-                        all_bundles.append(b_n1)
-                        if len(all_bundles) == self.neg_sample+1:
-                            break
-            elif CONFIG['hard_prob'][0] < hard_probability \
-                <= CONFIG['hard_prob'][0] + CONFIG['hard_prob'][1]:
-                while True:
-                    i = np.random.randint(self.b_b_for_neg_sample.shape[1])
-                    b_n2 = self.b_b_for_neg_sample[pos_bundle, i]
-                    if self.ground_truth_u_b[user_b, b_n2] == 0 and not b_n2 in all_bundles:
-                        all_bundles.append(b_n2)
-                        if len(all_bundles) == self.neg_sample+1:
-                            break
-            else:
-                while True:
-                    i = np.random.randint(self.num_bundles)
-                    if self.ground_truth_u_b[user_b, i] == 0 and not i in all_bundles:
-                        all_bundles.append(i)
-                        if len(all_bundles) == self.neg_sample+1:
-                            break
+            # one source per pair: 0: u_p --> b_n1, 1: b_p --> b_n2, 2: uniform
+            hard_probability = np.round(np.random.uniform(0, 1, size=users.shape[0]), 1)
+            source = np.full(users.shape[0], 2)
+            source[hard_probability <= CONFIG['hard_prob'][0]] = 0
+            source[(CONFIG['hard_prob'][0] < hard_probability)
+                   & (hard_probability <= CONFIG['hard_prob'][0] + CONFIG['hard_prob'][1])] = 1
+
+            def draw(idx):
+                candidates = uniform(idx)
+                mask = source[idx] == 0
+                candidates[mask] = self.u_b_for_neg_sample.draw(users[idx[mask]])
+                mask = source[idx] == 1
+                candidates[mask] = self.b_b_for_neg_sample.draw(pos_bundles[idx[mask]])
+                return candidates
+            negs = sample_negatives(self.positive_u_b, users, self.neg_sample, draw, fallback=uniform)
+        elif CONFIG['sample'] == 'popularity':
+            popular = lambda idx: self.bundle_alias.draw(idx.shape[0])
+            negs = sample_negatives(self.positive_u_b, users, self.neg_sample, popular, fallback=uniform)
+        elif CONFIG['sample'] == 'mixed':
+            def draw(idx):
+                candidates = uniform(idx)
+                mask = np.random.uniform(0, 1, size=idx.shape[0]) < CONFIG['pop_prob']
+                candidates[mask] = self.bundle_alias.draw(mask.sum())
+                return candidates
+            negs = sample_negatives(self.positive_u_b, users, self.neg_sample, draw)
         else:
             raise ValueError(r"sample's method is wrong")
+        return np.concatenate([pos_bundles[:, None], negs], axis=1)
 
-        return torch.LongTensor([user_b]), torch.LongTensor(all_bundles)
+    def __getitem__(self, index):
+        '''
+        `index`: int, or a list of ints when used with a `BatchSampler` (`batch_size=None`),
+        the whole batch is then sampled at once
+        '''
+        if np.isscalar(index):
+            users, bundles = self[[index]]
+            return users[0], bundles[0]
+        pairs = np.asarray(self.U_B_pairs[np.asarray(index)], dtype=np.int64)
+        users, pos_bundles = pairs[:, 0], pairs[:, 1]
+        all_bundles = self.sample(users, pos_bundles)
+        return torch.from_numpy(users).unsqueeze(1), torch.from_numpy(all_bundles)
 
     def __len__(self):
         return len(self.U_B_pairs)  
 
 
+def _write_negative_table(dataset, seed, epoch, filename, block_size=1 << 16):
+    np.random.seed([seed, epoch])
+    order = np.random.permutation(len(dataset))
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    table = np.lib.format.open_memmap(
+        tmp, mode='w+', dtype=np.int32, shape=(len(dataset), 2+dataset.neg_sample))
+    for start in range(0, len(dataset), block_size):
+        pairs = np.asarray(dataset.U_B_pairs[order[start:start+block_size]], dtype=np.int64)
+        table[start:start+pairs.shape[0], 0] = pairs[:, 0]
+        table[start:start+pairs.shape[0], 1:] = dataset.sample(pairs[:, 0], pairs[:, 1])
+    table.flush()
+    del table
+    os.replace(tmp, filename)
+
+
+class EpochNegativeTable(object):
+    '''
+    replaces the train `DataLoader`: the shuffled (`user`, `bundle_p`, `bundle_n1`, ...) table of
+    epoch N+1 is sampled by a background process into an int32 .npy memmap while epoch N trains,
+    the training loop then only slices contiguous batches out of it
+
+    the RNG of an epoch is seeded by (`seed`, epoch), `state_dict`/`load_state_dict` checkpoint it
+    Args:
+    - `dataset`: `BundleTrainDataset`
+    - `table_path`: dir of the tables (e.g. under /dev/shm)
+    '''
+
+    def __init__(self, dataset, batch_size, table_path, seed=123):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.table_path = table_path
+        self.seed = seed
+        self.epoch = 0
+        self._worker = None
+        self._worker_epoch = None
+        os.makedirs(table_path, exist_ok=True)
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _filename(self, epoch):
+        return os.path.join(self.table_path, 'negative_{}_{}.npy'.format(self.seed, epoch))
+
+    def _prefetch(self, epoch):
+        self._worker = multiprocessing.Process(
+            target=_write_negative_table, args=(self.dataset, self.seed, epoch, self._filename(epoch)), daemon=True)
+        self._worker.start()
+        self._worker_epoch = epoch
+
+    def _wait(self, epoch):
+        if self._worker_epoch != epoch:
+            self.close()
+            self._prefetch(epoch)
+        self._worker.join()
+        self._worker, self._worker_epoch = None, None
+        if not os.path.exists(self._filename(epoch)):
+            raise RuntimeError('fail to build the negative table of epoch {}'.format(epoch))
+
+    def __iter__(self):
+        epoch = self.epoch
+        self._wait(epoch)
+        table = np.load(self._filename(epoch), mmap_mode='r')
+        self.epoch += 1
+        self._prefetch(self.epoch)
+        try:
+            for start in range(0, table.shape[0], self.batch_size):
+                batch = torch.from_numpy(table[start:start+self.batch_size].astype(np.int64))
+                yield batch[:, :1], batch[:, 1:]
+        finally:
+            del table
+            os.remove(self._filename(epoch))
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state):
+        self.close()
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.terminate()
+            self._worker.join()
+            filename = self._filename(self._worker_epoch)
+            for f in (filename, '{}.{}.tmp'.format(filename, self._worker.pid)):
+                if os.path.exists(f):
+                    os.remove(f)
+            self._worker, self._worker_epoch = None, None
+
+
 class BundleTestDataset(BasicDataset):
     def __init__(self, path, name, train_dataset, task='test'):
         super().__init__(path, name, task, None)
         # U-B
-        self.U_B_pairs = self.load_U_B_interaction()
-        indice = np.array(self.U_B_pairs, dtype=np.int32)
-        values = np.ones(len(self.U_B_pairs), dtype=np.float32)
-        self.ground_truth_u_b = sp.coo_matrix(
-            (values, (indice[:, 0], indice[:, 1])), shape=(self.num_users, self.num_bundles)).tocsr()
-
-        print_statistics(self.ground_truth_u_b, 'U-B statistics in test')
+        self.U_B_pairs, self.ground_truth_u_b, stats = self.load_U_B_interaction()
+        print_statistics(self.ground_truth_u_b, 'U-B statistics in test', stats)
 
         self.train_mask_u_b = train_dataset.ground_truth_u_b
-        self.users = torch.arange(self.num_users, dtype=torch.long).unsqueeze(dim=1)
-        self.bundles = torch.arange(self.num_bundles, dtype=torch.long)
         assert self.train_mask_u_b.shape == self.ground_truth_u_b.shape
+        # users without test positives count for no metric
+        self.users = np.flatnonzero(np.diff(self.ground_truth_u_b.indptr))
+        self._negatives = {}
+
+    def sampled_negatives(self, num_neg, seed=123):
+        '''
+        int64 tensor [len(`users`), `num_neg`]: distinct bundles outside the test and train interactions
+        of every user in `users`, drawn once per split for a (`num_neg`, `seed`), the same in every run
+        '''
+        if (num_neg, seed) not in self._negatives:
+            positive = PositiveIndex(self.ground_truth_u_b + self.train_mask_u_b)
+            rng = np.random.RandomState(seed)
+            uniform = lambda idx: rng.randint(self.num_bundles, size=idx.shape[0])
+            self._negatives[num_neg, seed] = torch.from_numpy(
+                sample_negatives(positive, self.users, num_neg, uniform))
+        return self._negatives[num_neg, seed]
+
+    @staticmethod
+    def _csr_slice(csr, users):
+        rows = csr[users]
+        return torch.from_numpy(rows.indptr.astype(np.int64)), torch.from_numpy(rows.indices.astype(np.int64))
 
     def __getitem__(self, index):
-        return index, torch.from_numpy(self.ground_truth_u_b[index].toarray()).squeeze(),  \
-            torch.from_numpy(self.train_mask_u_b[index].toarray()).squeeze(),  \
+        '''
+        `index`: int, or a list of ints when used with a `BatchSampler` (`batch_size=None`), into `users`
+        return users, and the (indptr, indices) of their ground truth and train mask rows
+        '''
+        if np.isscalar(index):
+            return self[[index]]
+        users = self.users[np.asarray(index)]
+        return torch.from_numpy(users.astype(np.int64)), \
+            self._csr_slice(self.ground_truth_u_b, users), self._csr_slice(self.train_mask_u_b, users)
 
     def __len__(self):
-        return self.ground_truth_u_b.shape[0]
+        return len(self.users)
+
+
+def get_test_loader(dataset, batch_size, num_workers=2):
+    '''
+    DataLoader of `BundleTestDataset` shipping one CSR slice per batch
+    '''
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(SequentialSampler(dataset), batch_size, False),
+                      num_workers=num_workers, pin_memory=True)
 
 class ItemDataset(BasicDataset):
     def __init__(self, path, name, assist_data, seed=None):
         super().__init__(path, name, 'train', 1)
         print(self.num_users, self.num_items)
         # U-I
-        self.U_I_pairs = self.load_U_I_interaction()
-        indice = np.array(self.U_I_pairs, dtype=np.int32)
-        values = np.ones(len(self.U_I_pairs), dtype=np.float32)
-        self.ground_truth_u_i = sp.coo_matrix( 
-            (values, (indice[:, 0], indice[:, 1])), shape=(self.num_users, self.num_items)).tocsr()
-
-        print_statistics(self.ground_truth_u_i, 'U-I statistics')
+        self.U_I_pairs, self.ground_truth_u_i, stats = self.load_U_I_interaction()
+        print_statistics(self.ground_truth_u_i, 'U-I statistics', stats)
+        self.positive_u_i = PositiveIndex(self.ground_truth_u_i)
+
+    def sample(self, users, pos_items):
+        '''
+        draw `neg_sample` uniform negatives for a batch of (`users`, `pos_items`) pairs
+        return int64 array [n, 1+`neg_sample`], column 0 is `pos_items`
+        '''
+        uniform = lambda idx: np.random.randint(self.num_items, size=idx.shape[0])
+        negs = sample_negatives(self.positive_u_i, users, self.neg_sample, uniform)
+        return np.concatenate([pos_items[:, None], negs], axis=1)
 
     def __getitem__(self, index):
-        user_i, pos_item = self.U_I_pairs[index]
-        all_items = [pos_item]
-        while True:
-            j = np.random.randint(self.num_items)
-            if self.ground_truth_u_i[user_i, j] == 0 and not j in all_items:
-                all_items.append(j)
-                if len(all_items) == self.neg_sample+1:
-                    break
-
-        return torch.LongTensor([user_i]), torch.LongTensor(all_items)
+        '''
+        `index`: int, or a list of ints when used with a `BatchSampler` (`batch_size=None`)
+        '''
+        if np.isscalar(index):
+            users, items = self[[index]]
+            return users[0], items[0]
+        pairs = np.asarray(self.U_I_pairs[np.asarray(index)], dtype=np.int64)
+        users, pos_items = pairs[:, 0], pairs[:, 1]
+        all_items = self.sample(users, pos_items)
+        return torch.from_numpy(users).unsqueeze(1), torch.from_numpy(all_items)
 
     def __len__(self):
         return len(self.U_I_pairs)  
@@ -198,25 +572,38 @@ class AssistDataset(BasicDataset):
     def __init__(self, path, name):
         super().__init__(path, name, None, None)
         # B-I
-        self.B_I_pairs = self.load_B_I_affiliation()
-        indice = np.array(self.B_I_pairs, dtype=np.int32)
-        values = np.ones(len(self.B_I_pairs), dtype=np.float32)
-        self.ground_truth_b_i = sp.coo_matrix(
-            (values, (indice[:, 0], indice[:, 1])), shape=(self.num_bundles, self.num_items)).tocsr()
+        self.B_I_pairs, self.ground_truth_b_i, stats = self.load_B_I_affiliation()
+        print_statistics(self.ground_truth_b_i, 'B-I statistics', stats)
 
-        print_statistics(self.ground_truth_b_i, 'B-I statistics')
 
+class DatasetSession(object):
+    '''
+    load the train graph and the side matrices (U-I, B-I) of a dataset once,
+    every split from `get_test_dataset` references them instead of reloading
+    Args:
+    - `path`: the path of dir that contains dataset dir
+    - `name`: the name of dataset (used as the name of dir)
+    - `seed`: seed passed to the train datasets
+    '''
 
-def get_dataset(path, name, task='tune', seed=123):
-    assist_data = AssistDataset(path, name)
-    print('finish loading assist data')
-    item_data = ItemDataset(path, name, assist_data, seed=seed)
-    print('finish loading item data')
+    def __init__(self, path, name, seed=123):
+        self.path = path
+        self.name = name
+        self.assist_data = AssistDataset(path, name)
+        print('finish loading assist data')
+        self.item_data = ItemDataset(path, name, self.assist_data, seed=seed)
+        print('finish loading item data')
+        self.bundle_train_data = BundleTrainDataset(path, name, self.item_data, self.assist_data, seed=seed)
+        print('finish loading bundle train data')
+        self._test_data = {}
 
-    bundle_train_data = BundleTrainDataset(path, name, item_data, assist_data, seed=seed)
-    print('finish loading bundle train data')
-    bundle_test_data = BundleTestDataset(path, name, bundle_train_data, task=task)
-    print('finish loading bundle test data')
+    def get_test_dataset(self, task):
+        if task not in self._test_data:
+            self._test_data[task] = BundleTestDataset(self.path, self.name, self.bundle_train_data, task=task)
+            print('finish loading bundle {} data'.format(task))
+        return self._test_data[task]
 
-    return bundle_train_data, bundle_test_data, item_data, assist_data
 
+def get_dataset(path, name, task='tune', seed=123):
+    session = DatasetSession(path, name, seed=seed)
+    return session.bundle_train_data, session.get_test_dataset(task), session.item_data, session.assist_data
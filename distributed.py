@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def launch(fn, CONFIG):
+    '''
+    run `fn(rank, world_size)` in `CONFIG['nproc_per_node']` processes on each of `CONFIG['nnodes']` nodes,
+    a single call of `fn(0, 1)` if there is only one
+    '''
+    nprocs = CONFIG['nproc_per_node']
+    world_size = nprocs * CONFIG['nnodes']
+    if world_size == 1:
+        return fn(0, 1)
+    mp.spawn(_worker, args=(fn, CONFIG, world_size), nprocs=nprocs)
+
+
+def _worker(local_rank, fn, CONFIG, world_size):
+    rank = CONFIG['node_rank'] * CONFIG['nproc_per_node'] + local_rank
+    os.environ['MASTER_ADDR'] = CONFIG['master_addr']
+    os.environ['MASTER_PORT'] = str(CONFIG['master_port'])
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # the cores of a node are split between its processes
+    torch.set_num_threads(max(1, os.cpu_count() // CONFIG['nproc_per_node']))
+    try:
+        fn(rank, world_size)
+    finally:
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_master():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def broadcast_parameters(model):
+    '''
+    copy the parameters of rank 0 to all ranks
+    '''
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for p in model.parameters():
+            dist.broadcast(p, 0)
+
+
+def all_reduce_gradients(model):
+    '''
+    average the gradients of `model` over all ranks, dense ones in one flat buffer
+    '''
+    if not is_distributed():
+        return
+    world_size = dist.get_world_size()
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    dense = [g for g in grads if not g.is_sparse]
+    if dense:
+        flat = _flatten_dense_tensors(dense)
+        dist.all_reduce(flat)
+        flat /= world_size
+        for g, reduced in zip(dense, _unflatten_dense_tensors(flat, dense)):
+            g.copy_(reduced)
+    for p in model.parameters():
+        if p.grad is not None and p.grad.is_sparse:
+            # gloo sums sparse tensors by concatenating their entries
+            grad = p.grad.coalesce()
+            dist.all_reduce(grad)
+            p.grad = grad.coalesce() / world_size
+
+
+class _AllReduceSum(torch.autograd.Function):
+    '''
+    sum over all ranks, each rank's input is used by the losses of all ranks, so is its gradient
+    '''
+    @staticmethod
+    def forward(ctx, tensor):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+def all_reduce_sum(tensor):
+    '''
+    differentiable sum of `tensor` over all ranks
+    '''
+    if not is_distributed():
+        return tensor
+    return _AllReduceSum.apply(tensor)
+
+
+def broadcast_flag(flag):
+    '''
+    the value of `flag` on rank 0, on all ranks
+    '''
+    if not is_distributed():
+        return flag
+    flag = torch.tensor([int(flag)])
+    dist.broadcast(flag, 0)
+    return bool(flag.item())
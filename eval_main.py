@@ -2,135 +2,108 @@
 # -*- coding: utf-8 -*-
 
 import os
+import multiprocessing
 import torch
-import torch.nn as nn
-from torch.utils.data import DataLoader
 import setproctitle
 import dataset
-from model import BGCN, BGCN_Info, NGCF, NGCF_Info, BasConv, BasConv_Info, GCN, GCN_Info, RGCN, RGCN_Info, GCNBG, GCNBG_Info, NGCFBG_Info, NGCFBG, DGCF_Info, DGCF, VAE_Info, VAE, DGCF_UBinten_Info, DGCF_UBinten, DGCF_UBinten_v2_Info, DGCF_UBinten_v2, DGCF_Iinten, DGCF_Iinten_Info,DGCF_BIinten, DGCF_BIinten_Info,DGCF_BI3inten, DGCF_BI3inten_Info
-from utils import check_overfitting, early_stop, get_perf, logger 
-from train import train
+from model import load_MIDGN
 from metric import Recall, NDCG, MRR, Precision
 from config import CONFIG
 from test import test
-import loss
-import time
 import csv
 
 TAG = ''
 
+
+def read_checkpoints(DIR):
+    '''
+    paths of the best Recall@20 checkpoints of the rows of `DIR`/model.csv, the rows hold their training
+    hyperparameters, which do not change the evaluation
+    '''
+    with open(os.path.join(DIR, 'model.csv'), 'r') as f:
+        return [os.path.join(DIR, line['hash'] + "_Recall@20.pth") for line in csv.DictReader(f)]
+
+
+def _init_eval_worker(model, loader, device, metrics, threads):
+    global _eval_state
+    _eval_state = (model, loader, device, metrics)
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+def _eval_checkpoint(path):
+    '''
+    metrics of the checkpoint at `path`, by the model and loader shared with the parent
+    '''
+    model, loader, device, metrics = _eval_state
+    model.load_state_dict(torch.load(path, map_location=device))
+    test(model, loader, device, CONFIG, metrics)
+    return [metric.metric for metric in metrics]
+
+
 def main():
+    '''
+    evaluate the best checkpoints of every row of `model.csv` in each dir of `CONFIG['test']`, and write
+    one table of all of them to `<log>/<dataset>/<model>_<eval_task>/eval.csv`
+
+    the datasets, graphs and model are built once, on CPU the checkpoints are spread over
+    `CONFIG['eval_workers']` forked processes that share them read-only
+    '''
     # set env
     setproctitle.setproctitle(f"test{CONFIG['name']}")
     os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    assert CONFIG['model'] == 'MIDGN'
+
+    paths = [path for DIR in CONFIG['test'] for path in read_checkpoints(DIR)]
+    for path in paths:
+        if not os.path.exists(path):
+            print('skip {}: no checkpoint'.format(path))
+    paths = [path for path in paths if os.path.exists(path)]
+    workers = min(CONFIG['eval_workers'], len(paths))
+    use_pool = device.type == 'cpu' and workers > 1
+    if use_pool:
+        # a process forked after OpenMP started its threads hangs in its first parallel op: the parent
+        # runs single-threaded from here on, every worker gets its share of the threads
+        threads = max(1, torch.get_num_threads() // workers)
+        torch.set_num_threads(1)
 
     # load data
-    bundle_train_data, bundle_test_data, item_data, assist_data = \
-        dataset.get_dataset(CONFIG['path'], CONFIG['dataset_name'], task=CONFIG['eval_task'])
-    bundle_test_loader = DataLoader(bundle_test_data, 8039, False,
-                             num_workers=16, pin_memory=True)
-    test_loader = bundle_test_loader
-
-    #  graph
-    ub_graph = bundle_train_data.ground_truth_u_b
-    ui_graph = item_data.ground_truth_u_i
-    bi_graph = assist_data.ground_truth_b_i
+    session = dataset.DatasetSession(CONFIG['path'], CONFIG['dataset_name'])
+    bundle_test_data = session.get_test_dataset(CONFIG['eval_task'])
 
     # metric
     metrics = [Recall(5), NDCG(5),Recall(20), NDCG(20), Recall(40), NDCG(40), Recall(80), NDCG(80)]
     TARGET = 'Recall@20'
 
-    # log
-    log = logger.Logger(os.path.join(
-        CONFIG['log'], CONFIG['dataset_name'], 
-        f"{CONFIG['model']}_{CONFIG['eval_task']}", TAG), 'best', checkpoint_target=TARGET)
-
-    for DIR in CONFIG['test']:
-        with open(os.path.join(DIR, 'model.csv'), 'r') as f:
-            d = csv.DictReader(f)
-            d = [line for line in d]
-        for i in range(len(d)):
-            s = d[i][None][0]
-            dd = {'hash': d[i]['hash'],
-                  'embed_L2_norm': float(d[i][' embed_L2_norm']),
-                  'mess_dropout': float(d[i][' mess_dropout']),
-                  'node_dropout': float(d[i][' node_dropout']),
-                  'lr': float(s[s.find(':') + 1:])}
-
-            # model
-            if CONFIG['model'] == 'BGCN':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = BGCN_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = BGCN(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'NGCF':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = NGCF_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = NGCF(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'BasConv':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = BasConv_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = BasConv(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'GCN':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = GCN_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = GCN(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'RGCN':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = RGCN_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = RGCN(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'GCNBG':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = GCNBG_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = GCNBG(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'NGCFBG':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = NGCFBG_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = NGCFBG(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'DGCF':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = DGCF_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = DGCF(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'VAE':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = VAE_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = VAE(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'DGCF_UBinten':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = DGCF_UBinten_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = DGCF_UBinten(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'DGCF_UBinten_v2':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = DGCF_UBinten_v2_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = DGCF_UBinten_v2(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'DGCF_Iinten':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = DGCF_Iinten_Info(32, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = DGCF_Iinten(info, assist_data, graph, device, pretrain=None).to(device)
-            elif CONFIG['model'] == 'DGCF_BIinten':
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = DGCF_BIinten_Info(128, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = DGCF_BIinten(info, assist_data, graph, device, pretrain=None).to(device)
-            else:
-                graph = [ub_graph, ui_graph, bi_graph]
-                info = DGCF_BI3inten_Info(64, dd['embed_L2_norm'], dd['mess_dropout'], dd['node_dropout'], 2)
-                model = DGCF_BI3inten(info, assist_data, graph, device, pretrain=None).to(device)
-            assert model.__class__.__name__ == CONFIG['model']
-
-            model.load_state_dict(torch.load(
-                os.path.join(DIR, dd['hash']+"_Recall@20.pth")))
-
-            # log
-            log.update_modelinfo(info, {'lr': dd['lr']}, metrics)
-
-            # test
-            test(model, test_loader, device, CONFIG, metrics)
-
-            # log
-            log.update_log(metrics, model) 
-
-            log.close_log(TARGET)
-    log.close()
+    # model, the hyperparameters of a row only matter for training
+    model = load_MIDGN(session, device)
+    model.eval()
+
+    if use_pool:
+        # a forked process shares the graphs of `model`, a daemonic one cannot start DataLoader workers
+        loader = dataset.get_test_loader(bundle_test_data, CONFIG['batch_size_test'], num_workers=0)
+        with multiprocessing.get_context('fork').Pool(
+                workers, initializer=_init_eval_worker,
+                initargs=(model, loader, device, metrics, threads)) as pool:
+            results = pool.map(_eval_checkpoint, paths, chunksize=1)
+    else:
+        loader = dataset.get_test_loader(bundle_test_data, CONFIG['batch_size_test'])
+        _init_eval_worker(model, loader, device, metrics, None)
+        results = [_eval_checkpoint(path) for path in paths]
+
+    # results
+    titles = [metric.get_title() for metric in metrics]
+    table = sorted(zip(paths, results), key=lambda x: x[1][titles.index(TARGET)], reverse=True)
+    log_path = os.path.join(CONFIG['log'], CONFIG['dataset_name'], f"{CONFIG['model']}_{CONFIG['eval_task']}", TAG)
+    os.makedirs(log_path, exist_ok=True)
+    with open(os.path.join(log_path, 'eval.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['checkpoint'] + titles)
+        for path, result in table:
+            writer.writerow([path] + result)
+    print('\t'.join(['checkpoint'] + titles))
+    for path, result in table:
+        print('\t'.join([path] + ['{:.5f}'.format(i) for i in result]))
 
 
 if __name__ == "__main__":
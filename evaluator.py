@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import copy
+import queue
+import torch
+import torch.multiprocessing as mp
+import dataset
+from snapshot import SnapshotScorer
+from test import test
+
+
+class _State(object):
+    '''
+    a `state_dict` taken at submit time, stands in for the model/sampler/snapshot given to `Logger.update_log`
+    '''
+
+    def __init__(self, state):
+        self.state = state
+
+    def state_dict(self):
+        return self.state
+
+
+def _worker(requests, results, eval_data, test_data, metrics, test_metrics, CONFIG):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # a daemonic process cannot start DataLoader workers
+    eval_loader = dataset.get_test_loader(eval_data, CONFIG['batch_size_test'], num_workers=0)
+    test_loader = dataset.get_test_loader(test_data, CONFIG['batch_size_test'], num_workers=0)
+    for epoch, users_feature, bundles_feature in iter(requests.get, None):
+        scorer = SnapshotScorer(users_feature, bundles_feature, device)
+        test(scorer, eval_loader, device, CONFIG, metrics, test=False, sampled=CONFIG['eval_negatives'])
+        test(scorer, test_loader, device, CONFIG, test_metrics)
+        results.put((epoch, [metric.metric for metric in metrics], [metric.metric for metric in test_metrics]))
+
+
+class AsyncEvaluator(object):
+    '''
+    `test` of the eval and test splits in a background process while training goes on
+    `submit` ships the embeddings of an `EmbeddingSnapshot` through shared memory, `poll` hands back
+    the finished evaluations in submit order with their results loaded into `metrics` and `test_metrics`
+    Args:
+    - `max_pending`: evaluations in flight before `poll` waits for the oldest
+    '''
+
+    def __init__(self, eval_data, test_data, metrics, test_metrics, CONFIG, max_pending=1):
+        ctx = mp.get_context('spawn')
+        self.metrics = metrics
+        self.test_metrics = test_metrics
+        self.max_pending = max_pending
+        self.pending = []
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_worker, daemon=True, args=(
+            self.requests, self.results, eval_data, test_data, metrics, test_metrics, CONFIG))
+        self.process.start()
+
+    def submit(self, epoch, model, sampler, snapshot):
+        '''
+        evaluate `snapshot` of `model` after `epoch`, the states of `model`, `sampler` (may be None)
+        and `snapshot` are kept for the checkpoint of `Logger.update_log`
+        '''
+        state = snapshot.state_dict()
+        model_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        sampler_state = None if sampler is None else _State(copy.deepcopy(sampler.state_dict()))
+        self.pending.append((epoch, _State(model_state), sampler_state, _State(state)))
+        self.requests.put((epoch, state['users_feature'], state['bundles_feature']))
+
+    def _get(self, block):
+        while True:
+            try:
+                return self.results.get(timeout=1) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('evaluation process exited with code {}'.format(self.process.exitcode))
+                if not block:
+                    return None
+
+    def poll(self, block=False):
+        '''
+        yield (epoch, model, sampler, snapshot) of every finished evaluation with its metrics loaded,
+        waiting while more than `max_pending` are in flight, or for all of them if `block`
+        '''
+        while self.pending:
+            result = self._get(block or len(self.pending) > self.max_pending)
+            if result is None:
+                return
+            epoch, values, test_values = result
+            assert epoch == self.pending[0][0]
+            for metric, value in zip(self.metrics + self.test_metrics, values + test_values):
+                metric.metric = value
+            yield self.pending.pop(0)
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join()
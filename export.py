@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import torch
+import numpy as np
+import dataset
+from model import load_MIDGN
+from snapshot import EmbeddingSnapshot
+from config import CONFIG
+
+FORMAT = 1
+VIEWS = ['atom', 'non_atom']
+DTYPES = {'fp32': np.float32, 'fp16': np.float16}
+
+
+def _id_array(map_path):
+    '''
+    raw ids by index from a `{raw id: index}` json, None if there is no such file
+    '''
+    if not os.path.exists(map_path):
+        return None
+    with open(map_path, 'r') as f:
+        id_map = json.load(f)
+    ids = [None] * len(id_map)
+    for raw, index in id_map.items():
+        ids[index] = raw
+    return np.array(ids)
+
+
+def export_embeddings(model, root, train_graph, dtype='fp32', snapshot=None, id_maps=None, info=None, state=None):
+    '''
+    write the user/bundle embeddings of both views, from one `propagate` of `model` (or `snapshot`, or
+    `state`: an `EmbeddingSnapshot.state_dict` such as the `.emb` file saved next to a checkpoint, then
+    `model` may be None), as version `<root>/v<n>` of an embedding store, next to the CSR of `train_graph` (U-B train
+    interactions) and the raw ids by index of `id_maps` ({'user': path, 'bundle': path} of the
+    `{raw id: index}` jsons of a dataset, may be None)
+
+    every array is a .npy of `dtype` (fp32 | fp16) memory-mapped by `EmbeddingStore`, `manifest.json`
+    describes them, the version dir is renamed into place complete and `<root>/LATEST` names it
+    return the path of the version
+    '''
+    if state is None:
+        state = (snapshot or EmbeddingSnapshot(model)).state_dict()
+    arrays = {}
+    for side in ('users', 'bundles'):
+        for view, feature in zip(VIEWS, state[side + '_feature']):
+            arrays['{}_{}'.format(side, view)] = feature.numpy().astype(DTYPES[dtype])
+    train_graph = train_graph.tocsr()
+    arrays['train_indptr'] = train_graph.indptr.astype(np.int64)
+    arrays['train_indices'] = train_graph.indices.astype(np.int32)
+    for side, map_path in (id_maps or {}).items():
+        ids = _id_array(map_path)
+        if ids is not None:
+            arrays['{}_ids'.format(side)] = ids
+
+    os.makedirs(root, exist_ok=True)
+    versions = [int(v[1:]) for v in os.listdir(root) if v.startswith('v') and v[1:].isdigit()]
+    version = 'v{}'.format(max(versions, default=0) + 1)
+    tmp = os.path.join(root, '.{}.{}'.format(version, os.getpid()))
+    os.makedirs(tmp)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        manifest = {'format': FORMAT,
+                    'version': version,
+                    'created': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+                    'model': CONFIG['model'] if model is None else model.__class__.__name__,
+                    'info': info,
+                    'step': state['step'],
+                    'dtype': dtype,
+                    'views': VIEWS,
+                    'num_users': int(arrays['users_atom'].shape[0]),
+                    'num_bundles': int(arrays['bundles_atom'].shape[0]),
+                    'arrays': {name: {'file': name + '.npy', 'shape': list(array.shape), 'dtype': array.dtype.str}
+                               for name, array in arrays.items()}}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.rename(tmp, os.path.join(root, version))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    latest = os.path.join(root, 'LATEST.{}'.format(os.getpid()))
+    with open(latest, 'w') as f:
+        f.write(version)
+    os.replace(latest, os.path.join(root, 'LATEST'))
+    return os.path.join(root, version)
+
+
+class EmbeddingStore(object):
+    '''
+    read-only view of a version of the store written by `export_embeddings`, the arrays are
+    memory-mapped, nothing is copied or parsed but `manifest.json`
+    Args:
+    - `root`: dir of the store
+    - `version`: e.g. 'v3', None: the one named by `<root>/LATEST`
+    '''
+
+    def __init__(self, root, version=None):
+        if version is None:
+            with open(os.path.join(root, 'LATEST'), 'r') as f:
+                version = f.read().strip()
+        self.path = os.path.join(root, version)
+        with open(os.path.join(self.path, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        assert self.manifest['format'] == FORMAT, 'unknown store format {}'.format(self.manifest['format'])
+        self.arrays = {name: np.load(os.path.join(self.path, meta['file']), mmap_mode='r')
+                       for name, meta in self.manifest['arrays'].items()}
+        self.num_users = self.manifest['num_users']
+        self.num_bundles = self.manifest['num_bundles']
+        self.users_feature = [self.arrays['users_' + view] for view in self.manifest['views']]
+        self.bundles_feature = [self.arrays['bundles_' + view] for view in self.manifest['views']]
+        self._index = {}
+
+    def train_bundles(self, user):
+        '''
+        bundles of the train interactions of `user`
+        '''
+        indptr = self.arrays['train_indptr']
+        return self.arrays['train_indices'][indptr[user]:indptr[user+1]]
+
+    def raw_id(self, side, index):
+        '''
+        raw id of `index` of `side` ('user' | 'bundle'), `index` itself if the dataset has no id map
+        '''
+        ids = self.arrays.get(side + '_ids')
+        return int(index) if ids is None else str(ids[index])
+
+    def index(self, side, raw_id):
+        '''
+        index of the raw id of `side` ('user' | 'bundle'), the map is built at the first call
+        '''
+        ids = self.arrays.get(side + '_ids')
+        if ids is None:
+            return int(raw_id)
+        if side not in self._index:
+            self._index[side] = {raw: i for i, raw in enumerate(ids.tolist())}
+        return self._index[side][raw_id]
+
+
+def main():
+    '''
+    python export.py checkpoint [fp32|fp16]: write the embeddings of a MIDGN checkpoint to a new version
+    of the store at `CONFIG['export']`, a `<checkpoint>.emb` snapshot (see `Logger.save_checkpoint`)
+    is exported as saved, without building the model
+    '''
+    os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = sys.argv[2] if len(sys.argv) > 2 else 'fp32'
+    assert dtype in DTYPES
+
+    session = dataset.DatasetSession(CONFIG['path'], CONFIG['dataset_name'])
+    if sys.argv[1].endswith('.emb'):
+        model, state = None, torch.load(sys.argv[1], map_location='cpu')
+    else:
+        model, state = load_MIDGN(session, device, sys.argv[1]), None
+
+    data_path = os.path.join(CONFIG['path'], CONFIG['dataset_name'])
+    id_maps = {side: os.path.join(data_path, '{}_id_map.json'.format(side)) for side in ('user', 'bundle')}
+    path = export_embeddings(model, os.path.join(CONFIG['export'], CONFIG['dataset_name']),
+                             session.bundle_train_data.ground_truth_u_b, dtype=dtype, id_maps=id_maps,
+                             info={'checkpoint': sys.argv[1], 'dataset': CONFIG['dataset_name']}, state=state)
+    print('export {}'.format(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import random
+import asyncio
+from time import time
+from urllib.parse import quote
+import numpy as np
+from export import EmbeddingStore
+from config import CONFIG
+
+
+async def request(reader, writer, target, close=False):
+    '''
+    (status, json body) of GET `target` on a kept-alive connection
+    '''
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nConnection: {}\r\n\r\n'.format(
+        target, CONFIG['serve_host'], 'close' if close else 'keep-alive').encode())
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return status, json.loads(body)
+
+
+async def client(users, topk, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection(CONFIG['serve_host'], CONFIG['serve_port'])
+    loop = asyncio.get_event_loop()
+    while loop.time() < deadline:
+        start = time()
+        status, _ = await request(reader, writer, '/recommend?user={}&k={}'.format(quote(random.choice(users)), topk))
+        if status == 200:
+            latencies.append(time() - start)
+        else:
+            errors.append(status)
+    writer.close()
+
+
+async def run(connections, seconds, topk, users):
+    latencies, errors = [], []
+    deadline = asyncio.get_event_loop().time() + seconds
+    start = time()
+    await asyncio.gather(*[client(users, topk, deadline, latencies, errors) for _ in range(connections)])
+    elapsed = time() - start
+    reader, writer = await asyncio.open_connection(CONFIG['serve_host'], CONFIG['serve_port'])
+    _, server = await request(reader, writer, '/metrics', close=True)
+    writer.close()
+
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99]) if latencies else (float('nan'),) * 2
+    print('client: {} connections, {} requests in {:.1f}s, {} errors\tp50: {:.2f}ms\tp99: {:.2f}ms\t'
+          'throughput: {:.0f} req/s'.format(connections, len(latencies), elapsed, len(errors), p50, p99,
+                                           len(latencies) / elapsed))
+    print('server: ' + '\t'.join('{}: {:.2f}'.format(k, v) if isinstance(v, float) else '{}: {}'.format(k, v)
+                                 for k, v in server.items()))
+
+
+def main():
+    '''
+    python load_test.py [connections] [seconds] [k]: closed-loop load on serve.py, each connection
+    keeps one request of a random user of the served store in flight
+    '''
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    topk = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    store = EmbeddingStore(os.path.join(CONFIG['export'], CONFIG['dataset_name']))
+    random.seed(123)
+    users = [str(store.raw_id('user', i)) for i in random.sample(range(store.num_users), min(10000, store.num_users))]
+    asyncio.run(run(connections, seconds, topk, users))
+
+
+if __name__ == "__main__":
+    main()
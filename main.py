@@ -7,12 +7,15 @@ import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 import random
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, DistributedSampler
 import setproctitle
 import dataset
-from model import MIDGN, MIDGN_Info
+from model import MIDGN, MIDGN_Info, ItemBPR, ItemBPR_Info
 from utils import check_overfitting, early_stop, logger
-from train import train
+from train import train, MultiOptimizer
+from distributed import launch, broadcast_parameters, broadcast_flag
+from snapshot import EmbeddingSnapshot
+from evaluator import AsyncEvaluator
 from metric import Recall, NDCG, MRR,Precision
 from config import CONFIG
 from test import test
@@ -21,14 +24,19 @@ from itertools import product
 import time
 from tensorboardX import SummaryWriter
 
-def main():
+def main(rank=0, world_size=1):
+    '''
+    `rank` of `world_size` processes, see `distributed.launch`:
+    each rank trains on its shard of the U-B pairs, rank 0 evaluates and logs
+    '''
     #  set env
     setproctitle.setproctitle(f"train{CONFIG['name']}")
     os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    master = rank == 0
 
-    #  fix seed
-    seed = 123
+    #  fix seed, per rank so that the ranks sample different negatives
+    seed = 123 + rank
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
@@ -38,22 +46,56 @@ def main():
     torch.backends.cudnn.deterministic = True
 
     #  load data
-    _, bundle_test_data, item_data, assist_data = \
-        dataset.get_dataset(CONFIG['path'], CONFIG['dataset_name'], task=CONFIG['eval_task'])
-    bundle_train_data, bundle_eval_data, item_data, assist_data = \
-            dataset.get_dataset(CONFIG['path'], CONFIG['dataset_name'], task=CONFIG['task'])
-
-    train_loader = DataLoader(bundle_train_data, CONFIG['batch_size_train'], True,
-                              num_workers=2, pin_memory=True)
-    eval_loader = DataLoader(bundle_eval_data, CONFIG['batch_size_test'], False,
-                             num_workers=2, pin_memory=True)
-    test_loader = DataLoader(bundle_test_data, CONFIG['batch_size_test'], False,
-                             num_workers=2, pin_memory=True)
+    session = dataset.DatasetSession(CONFIG['path'], CONFIG['dataset_name'], seed=seed)
+    bundle_train_data = session.bundle_train_data
+    item_data, assist_data = session.item_data, session.assist_data
+    bundle_eval_data = session.get_test_dataset(CONFIG['task'])
+    bundle_test_data = session.get_test_dataset(CONFIG['eval_task'])
+
+    if world_size > 1:
+        assert CONFIG['neg_table'] is None, 'neg_table does not shard the pairs'
+        # every rank draws its own `batch_size_train` pairs per step
+        train_sampler = BatchSampler(DistributedSampler(bundle_train_data, world_size, rank, seed=123),
+                                     CONFIG['batch_size_train'], False)
+        train_loader = DataLoader(bundle_train_data, batch_size=None, sampler=train_sampler,
+                                  num_workers=2, pin_memory=True)
+    elif CONFIG['neg_table'] is None:
+        # negatives of a whole batch are sampled at once by `BundleTrainDataset`
+        train_sampler = BatchSampler(RandomSampler(bundle_train_data), CONFIG['batch_size_train'], False)
+        train_loader = DataLoader(bundle_train_data, batch_size=None, sampler=train_sampler,
+                                  num_workers=2, pin_memory=True)
+    else:
+        train_loader = dataset.EpochNegativeTable(
+            bundle_train_data, CONFIG['batch_size_train'], CONFIG['neg_table'], seed=seed)
+    eval_loader = dataset.get_test_loader(bundle_eval_data, CONFIG['batch_size_test'])
+    test_loader = dataset.get_test_loader(bundle_test_data, CONFIG['batch_size_test'])
 
     #  pretrain
+    pretrain = None
     if 'pretrain' in CONFIG:
         pretrain = torch.load(CONFIG['pretrain'], map_location='cpu')
         print('load pretrain')
+    elif CONFIG['item_pretrain_epochs'] > 0:
+        # item-level BPR stage, warm-starts users_feature/items_feature_each of MIDGN
+        if world_size > 1:
+            item_sampler = BatchSampler(DistributedSampler(item_data, world_size, rank, seed=123),
+                                        CONFIG['batch_size_train'], False)
+        else:
+            item_sampler = BatchSampler(RandomSampler(item_data), CONFIG['batch_size_train'], False)
+        item_loader = DataLoader(item_data, batch_size=None, sampler=item_sampler,
+                                 num_workers=2, pin_memory=True)
+        # the same initial weights on every rank
+        torch.manual_seed(123)
+        item_model = ItemBPR(ItemBPR_Info(64, CONFIG['decays'][0]), assist_data).to(device)
+        torch.manual_seed(seed)
+        broadcast_parameters(item_model)
+        item_op = optim.Adam(item_model.parameters(), lr=CONFIG['lrs'][0])
+        for epoch in range(CONFIG['item_pretrain_epochs']):
+            if world_size > 1:
+                item_sampler.sampler.set_epoch(epoch)
+            train(item_model, epoch+1, item_loader, item_op, device, CONFIG, loss.BPRLoss('mean'))
+        pretrain = {k: v.detach().cpu() for k, v in item_model.state_dict().items()}
+        print('finish item pretrain')
 
     #  graph
     ub_graph = bundle_train_data.ground_truth_u_b
@@ -70,14 +112,18 @@ def main():
                     Recall(40), NDCG(40), Precision(40), 
                     Recall(80), NDCG(80), Precision(80)]
     TARGET = 'Recall@20'
+    # started before any model, the worker only receives embeddings
+    evaluator = AsyncEvaluator(bundle_eval_data, bundle_test_data, metrics, test_metrics, CONFIG) \
+        if master and CONFIG['async_eval'] else None
 
     #  loss
     loss_func = loss.BPRLossDGCF('mean')
     #loss_func=loss. BPRLoss('mean')
     #  log
-    log = logger.Logger(os.path.join(
-        CONFIG['log'], CONFIG['dataset_name'], 
-        f"{CONFIG['model']}_{CONFIG['task']}", ''), 'best', checkpoint_target=TARGET)
+    if master:
+        log = logger.Logger(os.path.join(
+            CONFIG['log'], CONFIG['dataset_name'], 
+            f"{CONFIG['model']}_{CONFIG['task']}", ''), 'best', checkpoint_target=TARGET)
 
     theta = 0.6
 
@@ -97,12 +143,23 @@ def main():
         print('MIDGN model')
         graph = [ub_graph, ui_graph, bi_graph]
         info = MIDGN_Info(64, decay, message_dropout, node_dropout, 2)
-        model =MIDGN(info, assist_data, graph, device, pretrain=None).to(device)
+        # the same initial weights on every rank
+        torch.manual_seed(123)
+        model =MIDGN(info, assist_data, graph, device, pretrain=pretrain).to(device)
+        torch.manual_seed(seed)
     
         assert model.__class__.__name__ == CONFIG['model']
+        snapshot = EmbeddingSnapshot(model)
 
         # op
-        op = optim.Adam(model.parameters(), lr=lr)
+        if CONFIG['subgraph_fanouts'] is not None:
+            # subgraph training gives the embedding tables sparse gradients
+            assert CONFIG['propagate_every'] == 1, 'propagate_every shares a full-graph propagate'
+            sparse = model.sparse_parameters()
+            dense = [p for p in model.parameters() if all(p is not q for q in sparse)]
+            op = MultiOptimizer(optim.SparseAdam(sparse, lr=lr), optim.Adam(dense, lr=lr))
+        else:
+            op = optim.Adam(model.parameters(), lr=lr)
         # env
         env = {'lr': lr,
                'op': str(op).split(' ')[0],   # Adam
@@ -114,54 +171,101 @@ def main():
         #  continue training
         if CONFIG['sample'] == 'hard' and 'conti_train' in CONFIG:
             model.load_state_dict(torch.load(CONFIG['conti_train']))
+            sampler_path = CONFIG['conti_train'] + '.sampler'
+            if isinstance(train_loader, dataset.EpochNegativeTable) and os.path.exists(sampler_path):
+                # continue with the negative tables of the next epoch
+                train_loader.load_state_dict(torch.load(sampler_path))
             print('load model and continue training')
+        broadcast_parameters(model)
 
         retry = CONFIG['retry']  # =1
         while retry >= 0:
             # log
-            log.update_modelinfo(info,
-                                 env, metrics)
+            if master:
+                log.update_modelinfo(info,
+                                     env, metrics)
             #try:
             if retry >=0:
 
                 # train & test
                 early = CONFIG['early']
-                train_writer = SummaryWriter(log_dir=visual_path, comment='train')
-                eval_writer = SummaryWriter(log_dir=visual_path, comment='eval')
+                if master:
+                    train_writer = SummaryWriter(log_dir=visual_path, comment='train')
+                    eval_writer = SummaryWriter(log_dir=visual_path, comment='eval')
+                sampler = train_loader if isinstance(train_loader, dataset.EpochNegativeTable) else None
+
+                def report(epoch, model, sampler, snapshot):
+                    '''
+                    log `metrics` of the evaluation after `epoch`, return whether to stop
+                    '''
+                    nonlocal early
+                    for metric in metrics:
+                        eval_writer.add_scalars('metric/all', {metric.get_title(): metric.metric}, epoch)
+                        if metric==metrics[0]:
+                            eval_writer.add_scalars('metric/single', {metric.get_title(): metric.metric}, epoch)
+
+                    # log
+                    log.update_log(metrics, model, sampler=sampler, snapshot=snapshot)
+
+                    # check overfitting
+                    stop = epoch > 10 and check_overfitting(log.metrics_log, TARGET, 1, show=False)
+                    # early stop
+                    if not stop:
+                        early = early_stop(
+                            log.metrics_log[TARGET], early, threshold=0)
+                        stop = early <= 0
+                    return stop
+
                 for epoch in range(CONFIG['epochs']):
                     # train
+                    if world_size > 1:
+                        train_sampler.sampler.set_epoch(epoch)
                     trainloss = train(model, epoch+1, train_loader, op, device, CONFIG, loss_func)
+                    if not master:
+                        # rank 0 tests and decides when to stop
+                        if epoch % CONFIG['test_interval'] == 0:
+                            if model.partitioned:
+                                # a partitioned propagate needs every rank, rank 0 takes one snapshot
+                                snapshot.get()
+                            if broadcast_flag(False):
+                                break
+                        continue
                     train_writer.add_scalars('loss/single', {"loss": trainloss}, epoch)
 
                     # test
                     if epoch % CONFIG['test_interval'] == 0:
-                        output_metrics = test(model, eval_loader, device, CONFIG, metrics, test=False)
-                        test_metrics = test(model, test_loader, device, CONFIG, test_metrics)
-                        for metric in output_metrics:
-                            eval_writer.add_scalars('metric/all', {metric.get_title(): metric.metric}, epoch)
-                            if metric==output_metrics[0]:
-                                eval_writer.add_scalars('metric/single', {metric.get_title(): metric.metric}, epoch)
-
-                        # log
-                        log.update_log(metrics, model)
-
-                        # check overfitting
-                        if epoch > 10:
-                            if check_overfitting(log.metrics_log, TARGET, 1, show=False):
-                                break
-                        # early stop
-                        early = early_stop(
-                            log.metrics_log[TARGET], early, threshold=0)
-                        if early <= 0:
+                        stop = False
+                        if evaluator is not None:
+                            # training goes on while the worker evaluates, earlier evaluations
+                            # are logged as they finish
+                            evaluator.submit(epoch, model, sampler, snapshot)
+                            for finished in evaluator.poll():
+                                stop = report(*finished) or stop
+                        else:
+                            # one propagate for both splits and the checkpoint
+                            test(model, eval_loader, device, CONFIG, metrics, test=False,
+                                 snapshot=snapshot, sampled=CONFIG['eval_negatives'])
+                            test(model, test_loader, device, CONFIG, test_metrics, snapshot=snapshot)
+                            stop = report(epoch, model, sampler, snapshot)
+                        if broadcast_flag(stop):
                             break
-                train_writer.close()
-                eval_writer.close()
-                log.close_log(TARGET)
+                if evaluator is not None:
+                    for finished in evaluator.poll(block=True):
+                        report(*finished)
+                if isinstance(train_loader, dataset.EpochNegativeTable):
+                    train_loader.close()
+                if master:
+                    train_writer.close()
+                    eval_writer.close()
+                    log.close_log(TARGET)
                 retry = -1
             # except RuntimeError:
             #    retry -= 1
-    log.close()
+    if master:
+        log.close()
+    if evaluator is not None:
+        evaluator.close()
 
 
 if __name__ == "__main__":
-    main()
+    launch(main, CONFIG)
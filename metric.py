@@ -4,22 +4,56 @@
 import torch
 import numpy as np
 
-_is_hit_cache = {}
-
-def get_is_hit(scores, ground_truth, topk):
-    global _is_hit_cache
-    cacheid = (id(scores), id(ground_truth))
-    if topk in _is_hit_cache and _is_hit_cache[topk]['id'] == cacheid:
-        return _is_hit_cache[topk]['is_hit']
-    else:
-        device = scores.device
-        _, col_indice = torch.topk(scores, topk)
-        row_indice = torch.zeros_like(col_indice) + torch.arange(
-            scores.shape[0], device=device, dtype=torch.long).view(-1, 1)
-        is_hit = ground_truth[row_indice.view(-1),
-                              col_indice.view(-1)].view(-1, topk)
-        _is_hit_cache[topk] = {'id': cacheid, 'is_hit': is_hit}
-        return is_hit
+class RankedHits(object):
+    '''
+    prefix sums over the ranked hits of a batch, from which every metric reads its value at any K
+    - is_hit: float, whether the ranked bundles/items are positives, shape=(users, k), best first
+    - num_pos: positives of each user, shape=(users,)
+    '''
+
+    def __init__(self, is_hit, num_pos):
+        device = is_hit.device
+        k = is_hit.shape[1]
+        discount = 1 / torch.log2(torch.arange(2, k+2, device=device, dtype=torch.float))
+        self.num_pos = num_pos.to(device)
+        self.hits = is_hit.cumsum(dim=1)  # hits in the top 1..k
+        self.dcg = (is_hit * discount).cumsum(dim=1)
+        self.idcg = discount.cumsum(dim=0)  # ideal DCG of 1..k positives
+        # 0-based rank of the first hit, k if none
+        first_hit = is_hit.argmax(dim=1)
+        self.first_hit = torch.where(self.hits[:, -1] > 0, first_hit, torch.full_like(first_hit, k))
+
+    def column(self, topk):
+        '''
+        index of K=`topk` in the prefix sums, the whole ranking if it is shorter
+        '''
+        return min(topk, self.hits.shape[1]) - 1
+
+
+class MetricEngine(object):
+    '''
+    all `metrics` from one top-max(K) ranking per batch, accumulated on the device
+    and synchronized once in `stop`
+    '''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.topk = max(metric.topk for metric in metrics)
+
+    def start(self):
+        for metric in self.metrics:
+            metric.start()
+
+    def __call__(self, is_hit, num_pos):
+        ranked = RankedHits(is_hit, num_pos)
+        for metric in self.metrics:
+            metric.update(ranked)
+
+    def stop(self):
+        sums = torch.stack([torch.as_tensor(metric._sum, dtype=torch.float) for metric in self.metrics])
+        cnts = torch.stack([torch.as_tensor(metric._cnt, dtype=torch.float) for metric in self.metrics])
+        for metric, value in zip(self.metrics, (sums / cnts).tolist()):
+            metric.metric = value
 
 
 class _Metric:
@@ -34,10 +68,23 @@ class _Metric:
     def metric(self):
         return self._metric
 
-    def __call__(self, scores, ground_truth):
+    @metric.setter
+    def metric(self, value):
+        '''
+        load a value computed elsewhere, e.g. by `MetricEngine.stop` or an evaluation process
+        '''
+        self._metric = value
+
+    def update(self, ranked):
         '''
-        - scores: model output
-        - ground_truth: one-hot test dataset shape=(users, all_bundles/all_items).
+        accumulate the batch of `RankedHits` `ranked`, users without positives are not counted
+        '''
+        self._cnt = self._cnt + (ranked.num_pos > 0).sum()
+        self._sum = self._sum + self.compute(ranked).sum()
+
+    def compute(self, ranked):
+        '''
+        metric of each user of `ranked`
         '''
         raise NotImplementedError
 
@@ -48,16 +95,12 @@ class _Metric:
         '''
         clear all
         '''
-        global _is_hit_cache
-        _is_hit_cache = {}
         self._cnt = 0
         self._metric = 0
         self._sum = 0
 
     def stop(self):
-        global _is_hit_cache
-        _is_hit_cache = {}
-        self._metric = self._sum/self._cnt
+        self._metric = float(self._sum)/float(self._cnt)
 
 class Recall(_Metric):
     '''
@@ -72,12 +115,8 @@ class Recall(_Metric):
     def get_title(self):
         return "Recall@{}".format(self.topk)
 
-    def __call__(self, scores, ground_truth):
-        is_hit = get_is_hit(scores, ground_truth, self.topk)
-        is_hit = is_hit.sum(dim=1)
-        num_pos = ground_truth.sum(dim=1)
-        self._cnt += scores.shape[0] - (num_pos == 0).sum().item()
-        self._sum += (is_hit/(num_pos+self.epison)).sum().item()
+    def compute(self, ranked):
+        return ranked.hits[:, ranked.column(self.topk)] / (ranked.num_pos + self.epison)
 
 class Precision(_Metric):
     '''
@@ -92,12 +131,8 @@ class Precision(_Metric):
     def get_title(self):
         return "Precision@{}".format(self.topk)
 
-    def __call__(self, scores, ground_truth):
-        is_hit = get_is_hit(scores, ground_truth, self.topk)
-        is_hit = is_hit.sum(dim=1)
-        num_pos = ground_truth.sum(dim=1)
-        self._cnt += scores.shape[0] - (num_pos == 0).sum().item()
-        self._sum += (is_hit/(self.topk+self.epison)).sum().item()
+    def compute(self, ranked):
+        return ranked.hits[:, ranked.column(self.topk)] / (self.topk + self.epison)
 
 class NDCG(_Metric):
     '''
@@ -105,39 +140,18 @@ class NDCG(_Metric):
     In this work, NDCG = log(2)/log(1+hit_positions)
     '''
 
-    def DCG(self, hit):
-        a = torch.log2(torch.arange(2, self.topk+2,
-                                          device=self.device, dtype=torch.float))
-        hit = torch.tensor(hit, device=self.device)
-        hit = hit / a
-        return hit.sum(-1)
-
-    def IDCG(self, num_pos):
-        hit = torch.zeros(self.topk, dtype=torch.float)
-        hit[:num_pos] = 1
-        return self.DCG(hit)
-
-    def __init__(self, topk, device=torch.device('cuda' if torch.cuda.is_available() else 'cpu')):
+    def __init__(self, topk):
         super().__init__()
         self.topk = topk
-        self.device = device
-        self.IDCGs = torch.empty(1 + self.topk, dtype=torch.float).to(self.device)
-        self.IDCGs[0] = 1  # avoid 0/0
-        for i in range(1, self.topk + 1):
-            self.IDCGs[i] = self.IDCG(i)
 
     def get_title(self):
         return "NDCG@{}".format(self.topk)
 
-    def __call__(self, scores, ground_truth):
-        device = scores.device
-        is_hit = get_is_hit(scores, ground_truth, self.topk)
-        num_pos = ground_truth.sum(dim=1).clamp(0, self.topk).to(torch.long).to(self.device)
-        dcg = self.DCG(is_hit)
-        idcg = self.IDCGs[num_pos]
-        ndcg = dcg/idcg.to(self.device)
-        self._cnt += scores.shape[0] - (num_pos == 0).sum().item()
-        self._sum += ndcg.sum().item()
+    def compute(self, ranked):
+        column = ranked.column(self.topk)
+        # users without positives have a DCG of 0, any IDCG avoids 0/0
+        num_pos = ranked.num_pos.clamp(1, column + 1).to(torch.long)
+        return ranked.dcg[:, column] / ranked.idcg[num_pos - 1]
 
 
 
@@ -149,16 +163,10 @@ class MRR(_Metric):
     def __init__(self, topk):
         super().__init__()
         self.topk = topk
-        self.denominator = torch.arange(1, self.topk+1, dtype=torch.float)
 
     def get_title(self):
         return "MRR@{}".format(self.topk)
 
-    def __call__(self, scores, ground_truth):
-        device = scores.device
-        is_hit = get_is_hit(scores, ground_truth, self.topk)
-        is_hit /= self.denominator.to(device)
-        first_hit_rr = is_hit.max(dim=1)[0]
-        num_pos = ground_truth.sum(dim=1)
-        self._cnt += scores.shape[0] - (num_pos == 0).sum().item()
-        self._sum += first_hit_rr.sum().item()
+    def compute(self, ranked):
+        first_hit = ranked.first_hit
+        return torch.where(first_hit < self.topk, 1 / (first_hit + 1).float(), torch.zeros_like(first_hit).float())
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.nn as nn
+from .model_base import Info, Model
+
+
+class ItemBPR_Info(Info):
+    def __init__(self, embedding_size, embed_L2_norm, n_factors=4):
+        super().__init__(embedding_size, embed_L2_norm)
+        assert isinstance(n_factors, int) and embedding_size % n_factors == 0
+        self.n_factors = n_factors
+
+
+class ItemBPR(Model):
+    '''
+    item-level BPR (MF) on U-I pairs, a cheap stage whose `state_dict` warm-starts
+    `users_feature`/`items_feature_each` of `MIDGN` through its `pretrain` argument
+
+    as in `MIDGN`, an item is `items_feature_each` repeated over the `n_factors` intents
+    '''
+
+    def get_infotype(self):
+        return ItemBPR_Info
+
+    def __init__(self, info, dataset):
+        super().__init__(info, dataset, create_embeddings=False)
+        self.n_factors = info.n_factors
+        self.users_feature = nn.Parameter(
+            torch.FloatTensor(self.num_users, self.embedding_size))
+        nn.init.xavier_normal_(self.users_feature)
+        self.items_feature_each = nn.Parameter(
+            torch.FloatTensor(self.num_items, self.embedding_size // self.n_factors))
+        nn.init.xavier_normal_(self.items_feature_each)
+
+    def propagate(self):
+        return self.users_feature, self.items_feature_each.repeat(1, self.n_factors)
+
+    def predict(self, users_feature, items_feature):
+        return torch.sum(users_feature * items_feature, 2)
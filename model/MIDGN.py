@@ -8,7 +8,15 @@ import scipy.sparse as sp
 import numpy as np
 from .model_base import Info, Model
 import pdb
+import sys
+try:
+    import resource
+except ImportError:  # not on Windows, `_report_graph` leaves out the peak RSS
+    resource = None
+from time import time
 from config import CONFIG
+from distributed import is_distributed, all_reduce_sum
+import torch.distributed as dist
 import torch_sparse
 from torch_sparse import SparseTensor
 from torch_sparse.mul import mul
@@ -63,6 +71,56 @@ def to_tensor(graph):
     #graph=SparseTensor(row=torch.tensor(graph.row, dtype=torch.long),col=torch.tensor(graph.col, dtype=torch.long),value=torch.tensor(values, dtype=torch.float),sparse_sizes=torch.Size(graph.shape))
     return graph
 
+def routing_index(graph):
+    '''
+    index tensors of the intent routing over `graph` (A)
+    - indices: [2, nnz], (h, t) of A
+    - indices_t: [2, nnz], (t, h) of A^T, sorted like the values `values[perm_t]` it is paired with
+    - perm_t: [nnz], the order `torch_sparse.transpose` gives the values of A^T
+    - diag_A, diag_B: [2, numA], [2, numB], indices of the degree matrices
+    '''
+    graph = graph.tocoo()
+    indices = torch.from_numpy(np.vstack((graph.row, graph.col)).astype(np.int64))
+    # transpose coalesces A^T, i.e. sorts its values by (t, h)
+    perm_t = torch.from_numpy(np.lexsort((graph.row, graph.col)).astype(np.int64))
+    diag_A = torch.arange(graph.shape[0], dtype=torch.long).expand(2, -1).contiguous()
+    diag_B = torch.arange(graph.shape[1], dtype=torch.long).expand(2, -1).contiguous()
+    return indices, indices[[1, 0]][:, perm_t].contiguous(), perm_t, diag_A, diag_B
+
+def degree_balanced_partition(degrees, num_parts):
+    '''
+    owner part of every node: nodes are dealt to the parts in snake order of decreasing degree,
+    so every part gets about the same number of nodes and edges
+    '''
+    order = np.argsort(-degrees, kind='stable')
+    snake = np.concatenate([np.arange(num_parts), np.arange(num_parts)[::-1]])
+    owner = np.empty(len(degrees), dtype=np.int64)
+    owner[order] = snake[np.arange(len(degrees)) % len(snake)]
+    return owner
+
+def select_rows(graph, rows):
+    '''
+    csr_matrix of the shape of `graph` with only the entries of the rows in mask `rows`
+    '''
+    graph = (sp.diags(rows.astype(np.float32)) @ graph).tocsr()
+    graph.eliminate_zeros()
+    return graph
+
+def sample_neighbors(graph, rows, fanout):
+    '''
+    sorted unique columns of at most `fanout` random entries of each of `rows` in csr_matrix `graph`
+    '''
+    starts = graph.indptr[rows]
+    degrees = graph.indptr[rows + 1] - starts
+    # offset of every entry within its row
+    offsets = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    positions = np.repeat(starts, degrees) + offsets
+    # shuffle the entries of each row, keep the first `fanout`
+    order = np.lexsort((np.random.random(len(positions)), np.repeat(np.arange(len(rows)), degrees)))
+    rank = np.empty_like(offsets)
+    rank[order] = offsets
+    return np.unique(graph.indices[positions[rank < fanout]])
+
 
 
 
@@ -84,6 +142,7 @@ class MIDGN(Model):
 
     def __init__(self, info, dataset, raw_graph, device, pretrain=None):
         super().__init__(info, dataset, create_embeddings=True)
+        self._register_load_state_dict_pre_hook(self._drop_removed_keys)
 
         self.epison = 1e-8
         self.cor_flag = 1
@@ -93,90 +152,64 @@ class MIDGN(Model):
         self.num_layers = 2
         self.n_iterations = 2
         self.pick_level = 1e10
+        # 'batched': all factors in one spmm per direction, 'loop': one factor at a time
+        self.routing = CONFIG['routing']
+        # 'bf16': the score GEMMs of `evaluate` in bfloat16 on CUDA, the SpMMs always accumulate in float32
+        self.precision = CONFIG['precision']
+        # None: train on the full graph, see `propagate_subgraph`
+        self.subgraph_fanouts = CONFIG['subgraph_fanouts']
+        # every rank holds the edges of its own users/bundles only, see `_partition`
+        self.partitioned = CONFIG['partition'] and is_distributed()
+        if self.partitioned:
+            assert self.routing == 'batched' and self.subgraph_fanouts is None
         emb_dim = int(int(self.embedding_size) / self.n_factors)
         self.items_feature_each = nn.Parameter(
             torch.FloatTensor(self.num_items, emb_dim)).to(device)
         nn.init.xavier_normal_(self.items_feature_each)
-        self.items_feature = torch.cat([self.items_feature_each for i in range(self.n_factors)], dim=1)
         assert isinstance(raw_graph, list)
         ub_graph, ui_graph, bi_graph = raw_graph
-        ui_graph_coo, ub_graph_coo, bi_graph_coo = ui_graph.tocoo(), ub_graph.tocoo(), bi_graph.tocoo()
-        ub_indices = torch.tensor([ub_graph_coo.row, ub_graph_coo.col], dtype=torch.long)
-        ub_values = torch.ones(ub_graph_coo.data.shape, dtype=torch.float)
-        bi_indices = torch.tensor([bi_graph_coo.row, bi_graph_coo.col], dtype=torch.long)
-        bi_values = torch.ones(bi_graph_coo.data.shape, dtype=torch.float)
-        ui_e_indices, ui_e_values = torch_sparse.spspmm(ub_indices, ub_values, bi_indices, bi_values, self.num_users,
-                                                        self.num_bundles, self.num_items)
-
-        ui_graph_e = sp.csr_matrix((np.array([1] * len(ui_e_values)), (ui_e_indices[0].numpy(), ui_e_indices[1].numpy())),
-            shape=(self.num_users, self.num_items))
-        ui_graph_e_coo = ui_graph_e.tocoo()
-        ui_graph_e_coo = ui_graph_e.tocoo()
-        self.ui_mask = ui_graph_e[ui_graph_coo.row, ui_graph_coo.col]
-        self.ui_e_mask = ui_graph[ui_graph_e_coo.row, ui_graph_e_coo.col]
+        if self.partitioned:
+            users, bundles = self._partition(ub_graph, ui_graph, bi_graph)
+            # this rank keeps the U-I/B-I rows of its own users/bundles only
+            ui_graph, raw_bi_graph = select_rows(ui_graph, users), bi_graph
+            bi_graph = select_rows(bi_graph, bundles)
+            self._register_boundary('ui', ui_graph)
+            self._register_boundary('bi', bi_graph)
         self.bi_graph, self.ui_graph = bi_graph, ui_graph
-        if ui_graph.shape == (self.num_users, self.num_items):
-            # add self-loop
-            atom_graph = sp.bmat([[sp.identity(ui_graph.shape[0]), ui_graph],
-                                  [ui_graph.T, sp.identity(ui_graph.shape[1])]])
-        else:
-            raise ValueError(r"raw_graph's shape is wrong")
-        self.ui_atom_graph = to_tensor(laplace_transform(atom_graph)).to(device)
+        # self-loop atom graphs, built on first access, see `ui_atom_graph`/`bi_atom_graph`
+        self._atom_graphs = {}
         if bi_graph.shape == (self.num_bundles, self.num_items):
-            # add self-loop
-            atom_graph = sp.bmat([[sp.identity(bi_graph.shape[0]), bi_graph],
-                                  [bi_graph.T, sp.identity(bi_graph.shape[1])]])
-        else:
-            raise ValueError(r"raw_graph's shape is wrong")
-        self.bi_atom_graph = to_tensor(laplace_transform(atom_graph)).to(device)
-        self.dnns_atom = nn.ModuleList([nn.Linear(
-            self.embedding_size, self.embedding_size) for l in range(self.num_layers)])
-        if bi_graph.shape == (self.num_bundles, self.num_items):
-            tmp = bi_graph.tocoo()
-            self.bi_graph_h = list(tmp.row)
-            self.bi_graph_t = list(tmp.col)
+            start = time()
+            self._register_routing_index('bi', bi_graph)
             self.bi_graph_shape = bi_graph.shape
+            self._report_graph('bi routing', start, self.bi_indices.shape[1], self._routing_index('bi'))
         else:
             raise ValueError(r"raw_graph's shape is wrong")
-        # self.bi_graph = to_tensor(laplace_transform(bi_graph)).to(device)
 
         if ui_graph.shape == (self.num_users, self.num_items):
-            # add self-loop
-            tmp = ui_graph.tocoo()
-            self.ui_graph_v = torch.tensor(tmp.data, dtype=torch.float).to(device)
-            self.ui_graph_h = list(tmp.row)
-            self.ui_graph_t = list(tmp.col)
+            start = time()
+            self._register_routing_index('ui', ui_graph)
             self.ui_graph_shape = ui_graph.shape
+            self._report_graph('ui routing', start, self.ui_indices.shape[1], self._routing_index('ui'))
         else:
             raise ValueError(r"raw_graph's shape is wrong")
-        if ub_graph.shape == (self.num_users, self.num_bundles):
-            # add self-loop
-            tmp = ub_graph.tocoo()
-            self.ub_graph_v = torch.tensor(tmp.data, dtype=torch.float).to(device)
-            self.ub_graph_h = list(tmp.row)
-            self.ub_graph_t = list(tmp.col)
-            self.ub_graph_shape = ub_graph.shape
-        else:
+        if ub_graph.shape != (self.num_users, self.num_bundles):
             raise ValueError(r"raw_graph's shape is wrong")
-        # self.ui_graph = to_tensor(laplace_transform(ui_graph)).to(device)
-        print('finish generating bi, ui graph')
+        if self.subgraph_fanouts is not None:
+            # the routing hops of `propagate_subgraph` walk both directions
+            self.iu_graph, self.ib_graph = ui_graph.T.tocsr(), bi_graph.T.tocsr()
 
         #  deal with weights
-        bi_norm = sp.diags(1 / (np.sqrt((bi_graph.multiply(bi_graph)).sum(axis=1).A.ravel()) + 1e-8)) @ bi_graph
-        bb_graph = bi_norm @ bi_norm.T
-
-        bundle_size = bi_graph.sum(axis=1) + 1e-8
-        bi_graph = sp.diags(1 / bundle_size.A.ravel()) @ bi_graph
-
-        if ub_graph.shape == (self.num_users, self.num_bundles) \
-                and bb_graph.shape == (self.num_bundles, self.num_bundles):
-            # add self-loop
-            non_atom_graph = sp.bmat([[sp.identity(ub_graph.shape[0]), ub_graph],
-                                      [ub_graph.T, bb_graph]])
+        start = time()
+        if self.partitioned:
+            non_atom_graph = self._partition_non_atom_graph(ub_graph, raw_bi_graph, users, bundles)
         else:
-            raise ValueError(r"raw_graph's shape is wrong")
-        self.non_atom_graph = to_tensor(laplace_transform(non_atom_graph)).to(device)
-        print('finish generating non-atom graph')
+            non_atom_graph = self._non_atom_graph(ub_graph, bi_graph)
+        self.non_atom_graph = to_tensor(non_atom_graph).to(device)
+        if self.subgraph_fanouts is not None:
+            self.non_atom_csr = non_atom_graph.tocsr()
+        self._report_graph('non-atom', start, self.non_atom_graph._nnz(),
+                           [self.non_atom_graph._indices(), self.non_atom_graph._values()])
 
         # copy from info
         self.act = self.info.act
@@ -195,10 +228,171 @@ class MIDGN(Model):
         if not pretrain is None:
             self.users_feature.data = F.normalize(
                 pretrain['users_feature'])
-            self.items_feature.data = F.normalize(
-                pretrain['items_feature'])
-            self.bundles_feature.data = F.normalize(
-                pretrain['bundles_feature'])
+            # `items_feature` is derived from `items_feature_each`, the pretrained table goes into
+            # the parameter, so it is trained and saved with the model
+            if 'items_feature_each' in pretrain:
+                # item-level stage (`ItemBPR`) trains users and per-factor items only
+                self.items_feature_each.data = F.normalize(
+                    pretrain['items_feature_each']).to(device)
+            else:
+                self.items_feature_each.data = F.normalize(
+                    pretrain['items_feature'][:, :emb_dim]).to(device)
+            if 'bundles_feature' in pretrain:
+                self.bundles_feature.data = F.normalize(
+                    pretrain['bundles_feature'])
+
+    @property
+    def items_feature(self):
+        '''
+        routing input of the items: `items_feature_each` repeated over the `n_factors` intents,
+        rebuilt on every access so it follows the trained (or loaded) table
+        '''
+        return torch.cat([self.items_feature_each for i in range(self.n_factors)], dim=1)
+
+    def _register_routing_index(self, name, graph):
+        '''
+        `routing_index` of `graph` as buffers `{name}_indices`, `{name}_indices_t`, `{name}_perm_t`,
+        `{name}_diag_A` and `{name}_diag_B`, built once and moved with the module
+        '''
+        for k, index in zip(('indices', 'indices_t', 'perm_t', 'diag_A', 'diag_B'), routing_index(graph)):
+            self.register_buffer('{}_{}'.format(name, k), index, persistent=False)
+
+    def _routing_index(self, graph):
+        if not isinstance(graph, str):
+            # index tensors of a sampled subgraph, see `propagate_subgraph`
+            return graph
+        return [getattr(self, '{}_{}'.format(graph, k)) for k in ('indices', 'indices_t', 'perm_t', 'diag_A', 'diag_B')]
+
+    def _non_atom_graph(self, ub_graph, bi_graph):
+        '''
+        Laplacian-normalized [[I, U-B], [B-U, B-B]], B-B from the cosine of the B-I rows
+        '''
+        bi_norm = sp.diags(1 / (np.sqrt((bi_graph.multiply(bi_graph)).sum(axis=1).A.ravel()) + 1e-8)) @ bi_graph
+        bb_graph = bi_norm @ bi_norm.T
+
+        if ub_graph.shape == (self.num_users, self.num_bundles) \
+                and bb_graph.shape == (self.num_bundles, self.num_bundles):
+            # add self-loop
+            non_atom_graph = sp.bmat([[sp.identity(ub_graph.shape[0]), ub_graph],
+                                      [ub_graph.T, bb_graph]])
+        else:
+            raise ValueError(r"raw_graph's shape is wrong")
+        return laplace_transform(non_atom_graph)
+
+    def _partition_non_atom_graph(self, ub_graph, bi_graph, users, bundles):
+        '''
+        the rows of the users/bundles of this rank of `_non_atom_graph`, the other rows are empty
+
+        the graph is symmetric, so its degrees (row and column sums) are computed from the full
+        U-B/B-I graphs without building it, B-B is multiplied out for the own bundles only
+        '''
+        bi_norm = sp.diags(1 / (np.sqrt((bi_graph.multiply(bi_graph)).sum(axis=1).A.ravel()) + 1e-8)) @ bi_graph
+        bi_norm = bi_norm.tocsr()
+        user_degree = 1 + ub_graph.sum(axis=1).A.ravel()
+        bundle_degree = ub_graph.sum(axis=0).A.ravel() + bi_norm @ bi_norm.sum(axis=0).A.ravel()
+        degree = sp.diags(1 / (np.sqrt(np.concatenate([user_degree, bundle_degree])) + 1e-8))
+        non_atom_graph = sp.bmat([[sp.diags(users.astype(np.float32)), select_rows(ub_graph, users)],
+                                  [select_rows(ub_graph.T, bundles), select_rows(bi_norm, bundles) @ bi_norm.T]])
+        non_atom_graph = (degree @ non_atom_graph @ degree).tocsr()
+        non_atom_graph.eliminate_zeros()
+        return non_atom_graph
+
+    def _partition(self, ub_graph, ui_graph, bi_graph):
+        '''
+        split users and bundles between the ranks with `degree_balanced_partition`
+        return the masks of the users and the bundles of this rank
+
+        items are not split: their side of the routing is summed over all ranks
+        '''
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        users = degree_balanced_partition(ui_graph.getnnz(axis=1) + ub_graph.getnnz(axis=1), world_size) == rank
+        bundles = degree_balanced_partition(bi_graph.getnnz(axis=1) + ub_graph.getnnz(axis=0), world_size) == rank
+        self.register_buffer('ui_owned', torch.from_numpy(users.astype(np.float32)).view(-1, 1),
+                             persistent=False)
+        self.register_buffer('bi_owned', torch.from_numpy(bundles.astype(np.float32)).view(-1, 1),
+                             persistent=False)
+        print('partition {}/{}: {} users, {} bundles'.format(rank, world_size, users.sum(), bundles.sum()))
+        return users, bundles
+
+    def _register_boundary(self, name, graph):
+        '''
+        items with edges on more than one rank in the routing graph `name`, whose rows of this rank are `graph`:
+        the other items are only read by the one rank holding their edges, so their side of the routing
+        is complete there without any exchange
+        '''
+        ranks = torch.from_numpy((graph.getnnz(axis=0) > 0).astype(np.int64))
+        dist.all_reduce(ranks)
+        boundary = torch.nonzero(ranks > 1).view(-1)
+        self.register_buffer('{}_boundary'.format(name), boundary, persistent=False)
+        print('partition {}: {} of {} items on the boundary'.format(name, boundary.shape[0], graph.shape[1]))
+
+    def _reduce_partition(self, tensor, graph=None):
+        '''
+        sum of `tensor` over the ranks
+        `graph`: name of a routing graph, `tensor` is [n_factors, items, ...] and only its rows of the
+        `_register_boundary` items are summed, the item rows this rank has no edges to are left partial
+        '''
+        if not self.partitioned:
+            return tensor
+        if graph is None:
+            return all_reduce_sum(tensor)
+        boundary = getattr(self, '{}_boundary'.format(graph))
+        return tensor.index_copy(1, boundary, all_reduce_sum(tensor.index_select(1, boundary)))
+
+    def _gather_partition(self, graph, features):
+        '''
+        the rows of `features` from the ranks that own them, A side of routing graph `graph`
+
+        a dense all-reduce of the whole table: any rank may score any user or bundle, so every rank
+        needs every row, unlike the item side of the routing, see `_reduce_partition`
+        '''
+        if not self.partitioned or not isinstance(graph, str):
+            return features
+        return all_reduce_sum(features * getattr(self, '{}_owned'.format(graph)))
+
+    @staticmethod
+    def _report_graph(name, start, nnz, tensors):
+        '''
+        print the build time, nnz and tensor memory of graph `name`, with the peak RSS of the process so far
+        '''
+        size = sum(t.element_size() * t.nelement() for t in tensors)
+        report = 'graph {}: {:.2f}s, nnz {}, {:.1f}MB'.format(name, time() - start, nnz, size / 2 ** 20)
+        if resource is not None:
+            # ru_maxrss is in bytes on macOS, KB elsewhere
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report += ', max RSS {:.1f}MB'.format(rss / 2 ** (20 if sys.platform == 'darwin' else 10))
+        print(report)
+
+    def _atom_graph(self, name, graph):
+        if name not in self._atom_graphs:
+            start = time()
+            # add self-loop
+            atom_graph = sp.bmat([[sp.identity(graph.shape[0]), graph],
+                                  [graph.T, sp.identity(graph.shape[1])]])
+            atom_graph = to_tensor(laplace_transform(atom_graph)).to(self.device)
+            self._report_graph(name, start, atom_graph._nnz(), [atom_graph._indices(), atom_graph._values()])
+            self._atom_graphs[name] = atom_graph
+        return self._atom_graphs[name]
+
+    @property
+    def ui_atom_graph(self):
+        '''
+        Laplacian-normalized U-I graph with self-loops, not used by `propagate`
+        '''
+        return self._atom_graph('ui atom', self.ui_graph)
+
+    @property
+    def bi_atom_graph(self):
+        '''
+        Laplacian-normalized B-I graph with self-loops, not used by `propagate`
+        '''
+        return self._atom_graph('bi atom', self.bi_graph)
+
+    @staticmethod
+    def _drop_removed_keys(state_dict, prefix, *args):
+        # checkpoints saved before `dnns_atom` was removed still carry its weights
+        for key in [k for k in state_dict if k.startswith(prefix + 'dnns_atom.')]:
+            del state_dict[key]
 
     def one_propagate(self, graph, A_feature, B_feature, dnns):
         # node dropout on graph
@@ -241,26 +435,21 @@ class MIDGN(Model):
         return A_feature, B_feature
 
     def propagate(self):
+        items_feature = self.items_feature
 
         # bi_value_sparse,ui_value_sparse=[],[]
-        ub_indices = torch.tensor([self.ub_graph_h, self.ub_graph_t], dtype=torch.long).to(self.device)
-        bi_indices = torch.tensor([self.bi_graph_h, self.bi_graph_t], dtype=torch.long).to(self.device)
-        ui_indices = torch.tensor([self.ui_graph_h, self.ui_graph_t], dtype=torch.long).to(self.device)
-
-        atom_bundles_feature, atom_item_feature, self.bi_avalues = self._create_star_routing_embed_with_p(self.bi_graph_h,
-                                                                                                     self.bi_graph_t,
+        atom_bundles_feature, atom_item_feature, self.bi_avalues = self._create_star_routing_embed_with_p('bi',
                                                                                                      self.bundles_feature,
-                                                                                                     self.items_feature,
+                                                                                                     items_feature,
                                                                                                      self.num_bundles,
                                                                                                      self.num_items,
                                                                                                      self.bi_graph_shape,
                                                                                                      n_factors=1,
                                                                                                      pick_=False)
 
-        atom_user_feature, atom_item_feature2, self.ui_avalues = self._create_star_routing_embed_with_p(self.ui_graph_h,
-                                                                                                   self.ui_graph_t,
+        atom_user_feature, atom_item_feature2, self.ui_avalues = self._create_star_routing_embed_with_p('ui',
                                                                                                    self.users_feature,
-                                                                                                   self.items_feature,
+                                                                                                   items_feature,
                                                                                                    self.num_users,
                                                                                                    self.num_items,
                                                                                                    self.ui_graph_shape,
@@ -272,12 +461,98 @@ class MIDGN(Model):
 
         non_atom_users_feature, non_atom_bundles_feature = self.ub_propagate(
             self.non_atom_graph, atom_user_feature, atom_bundles_feature)
+        # the rows of the other ranks are 0 here
+        non_atom_users_feature = self._reduce_partition(non_atom_users_feature)
+        non_atom_bundles_feature = self._reduce_partition(non_atom_bundles_feature)
 
         users_feature = [atom_user_feature, non_atom_users_feature]
         bundles_feature = [atom_bundles_feature, non_atom_bundles_feature]
 
         return users_feature, bundles_feature, atom_bundles_feature, atom_item_feature, atom_user_feature
 
+    def sparse_parameters(self):
+        '''
+        embedding tables, their gradients are sparse under `propagate_subgraph`
+        '''
+        return [p for p in (self.users_feature, self.bundles_feature, self.items_feature_each)
+                if isinstance(p, nn.Parameter)]
+
+    def _sample_routing_nodes(self, graph, graph_t, rows, fanouts):
+        '''
+        rows/columns of the bipartite `graph` within len(`fanouts`) hops of `rows`,
+        hop k follows at most `fanouts[k]` random edges of each node it expands
+        '''
+        sides = [rows, rows[:0]]
+        frontier = rows
+        for hop, fanout in enumerate(fanouts):
+            side = (hop + 1) % 2
+            neighbors = sample_neighbors(graph if side else graph_t, frontier, fanout)
+            frontier = np.setdiff1d(neighbors, sides[side], assume_unique=True)
+            sides[side] = np.union1d(sides[side], frontier)
+        return sides
+
+    def _subgraph_routing_index(self, graph, rows, cols):
+        return [index.to(self.device) for index in routing_index(graph[rows][:, cols])]
+
+    def propagate_subgraph(self, users, bundles):
+        '''
+        `propagate` on the sampled neighborhood of a training batch
+        - non-atom hop: at most `subgraph_fanouts[0]` U-B/B-B neighbors of every batch user and bundle,
+          the sampled rows of the non-atom graph are rescaled to their full row sums
+        - routing hops: `subgraph_fanouts[1:]` over U-I from those users and over B-I from those bundles,
+          the intent routing runs on the induced subgraphs
+
+        embeddings are gathered with sparse gradients
+        return (`propagate` outputs of the unique batch users/bundles, `users`, `bundles` as positions in them)
+        '''
+        fanouts = self.subgraph_fanouts
+        batch_users = np.unique(users.cpu().numpy())
+        batch_bundles = np.unique(bundles.cpu().numpy())
+        seeds = np.concatenate([batch_users, batch_bundles + self.num_users])
+        nodes = np.union1d(seeds, sample_neighbors(self.non_atom_csr, seeds, fanouts[0]))
+        atom_users = nodes[nodes < self.num_users]
+        atom_bundles = nodes[nodes >= self.num_users] - self.num_users
+        ui_users, ui_items = self._sample_routing_nodes(self.ui_graph, self.iu_graph, atom_users, fanouts[1:])
+        bi_bundles, bi_items = self._sample_routing_nodes(self.bi_graph, self.ib_graph, atom_bundles, fanouts[1:])
+
+        def lookup(ids):
+            return torch.from_numpy(ids.astype(np.int64)).to(self.device)
+
+        def position(nodes, ids):
+            return lookup(np.searchsorted(nodes, ids))
+
+        items_feature = F.embedding(lookup(bi_items), self.items_feature_each, sparse=True)
+        atom_bundles_feature, atom_item_feature, self.bi_avalues = self._create_star_routing_embed_with_p(
+            self._subgraph_routing_index(self.bi_graph, bi_bundles, bi_items),
+            F.embedding(lookup(bi_bundles), self.bundles_feature, sparse=True),
+            torch.cat([items_feature for i in range(self.n_factors)], dim=1),
+            len(bi_bundles), len(bi_items), (len(bi_bundles), len(bi_items)), n_factors=1, pick_=False)
+        items_feature = F.embedding(lookup(ui_items), self.items_feature_each, sparse=True)
+        atom_user_feature, _, self.ui_avalues = self._create_star_routing_embed_with_p(
+            self._subgraph_routing_index(self.ui_graph, ui_users, ui_items),
+            F.embedding(lookup(ui_users), self.users_feature, sparse=True),
+            torch.cat([items_feature for i in range(self.n_factors)], dim=1),
+            len(ui_users), len(ui_items), (len(ui_users), len(ui_items)), n_factors=self.n_factors, pick_=False)
+
+        # non-atom rows of the batch over the sampled neighbors
+        graph = self.non_atom_csr[seeds]
+        row_sum = graph.sum(axis=1).A.ravel()
+        graph = graph[:, nodes]
+        graph = sp.diags(row_sum / (graph.sum(axis=1).A.ravel() + 1e-8)) @ graph
+        graph = to_tensor(graph).to(self.device)
+        graph = torch.sparse.FloatTensor(graph._indices(), self.node_dropout(graph._values()), size=graph.shape)
+        features = torch.cat((atom_user_feature[position(ui_users, atom_users)],
+                              atom_bundles_feature[position(bi_bundles, atom_bundles)]), 0)
+        non_atom_users_feature, non_atom_bundles_feature = torch.split(
+            torch.matmul(graph, features), (len(batch_users), len(batch_bundles)), 0)
+
+        users_feature = [atom_user_feature[position(ui_users, batch_users)], non_atom_users_feature]
+        bundles_feature = [atom_bundles_feature[position(bi_bundles, batch_bundles)], non_atom_bundles_feature]
+        propagate_result = (users_feature, bundles_feature, atom_bundles_feature, atom_item_feature,
+                            atom_user_feature)
+        return propagate_result, position(batch_users, users.cpu().numpy()), \
+            position(batch_bundles, bundles.cpu().numpy())
+
     def predict(self, users_feature, bundles_feature):
         users_feature_atom, users_feature_non_atom = users_feature  # batch_n_f
         bundles_feature_atom, bundles_feature_non_atom = bundles_feature  # batch_n_f
@@ -285,16 +560,19 @@ class MIDGN(Model):
                + torch.sum(users_feature_non_atom * bundles_feature_non_atom, 2)
         return pred
 
-    def forward(self, users, bundles):
-        users_feature, bundles_feature, atom_bundles_feature, atom_item_feature, atom_user_feature = self.propagate()
-        users_embedding = [i[users].expand(- 1, bundles.shape[1], -1) for i in
+    def forward(self, users, bundles, propagate_result=None):
+        users_index, bundles_index = users, bundles
+        if propagate_result is None:
+            if self.training and self.subgraph_fanouts is not None:
+                propagate_result, users_index, bundles_index = self.propagate_subgraph(users, bundles)
+            else:
+                propagate_result = self.propagate()
+        users_feature, bundles_feature, atom_bundles_feature, atom_item_feature, atom_user_feature = propagate_result
+        users_embedding = [i[users_index].expand(- 1, bundles.shape[1], -1) for i in
                            users_feature]  # u_f --> batch_f --> batch_n_f
-        bundles_embedding = [i[bundles] for i in bundles_feature]  # b_f --> batch_n_f
+        bundles_embedding = [i[bundles_index] for i in bundles_feature]  # b_f --> batch_n_f
         pred = self.predict(users_embedding, bundles_embedding)
         loss = self.regularize(users_embedding, bundles_embedding)
-        items = torch.tensor([np.random.choice(self.bi_graph[i].indices) for i in bundles.cpu()[:, 0]]).type(
-            torch.int64).to(self.device)
-
         loss = loss
         return pred, loss,  torch.zeros(1).to(self.device)[0]#-self.inten_score * 0.01  # self.cor_loss[0]#
 
@@ -306,23 +584,130 @@ class MIDGN(Model):
                 (users_feature_non_atom ** 2).sum() + (bundles_feature_non_atom ** 2).sum())
         return loss
 
-    def evaluate(self, propagate_result, users):
+    def evaluate(self, propagate_result, users, bundles=None):
         '''
         just for testing, compute scores of all bundles for `users` by `propagate_result`
+        `bundles`: index or slice of the scored bundles, None: all
         '''
         users_feature, bundles_feature, _, _, _ = propagate_result
         users_feature_atom, users_feature_non_atom = [i[users] for i in users_feature]  # batch_f
+        if bundles is not None:
+            bundles_feature = [i[bundles] for i in bundles_feature]
         bundles_feature_atom, bundles_feature_non_atom = bundles_feature  # b_f
+        if self.precision == 'bf16' and users_feature_atom.is_cuda:
+            # cuBLAS accumulates bfloat16 GEMMs in float32, the CPU kernels of torch 1.8 do not
+            users_feature_atom, users_feature_non_atom, bundles_feature_atom, bundles_feature_non_atom = [
+                i.bfloat16() for i in (users_feature_atom, users_feature_non_atom,
+                                       bundles_feature_atom, bundles_feature_non_atom)]
         scores = torch.mm(users_feature_atom, bundles_feature_atom.t()) \
                  + torch.mm(users_feature_non_atom, bundles_feature_non_atom.t())  # batch_b
-        return scores
+        return scores.float()
 
-    def _create_star_routing_embed_with_p(self, all_h_list, all_t_list, featureA, featureB, numA, numB, A_inshape, n_factors=4,
+    def _create_star_routing_embed_with_p(self, graph, featureA, featureB, numA, numB, A_inshape, n_factors=4,
                                           pick_=False):
         '''
         pick_ : True, the model would narrow the weight of the least important factor down to 1/args.pick_scale.
         pick_ : False, do nothing.
         '''
+        if self.routing == 'batched':
+            return self._create_star_routing_embed_batched(graph, featureA, featureB, numA, numB, A_inshape,
+                                                           n_factors=n_factors, pick_=pick_)
+        return self._create_star_routing_embed_loop(graph, featureA, featureB, numA, numB, A_inshape,
+                                                    n_factors=n_factors, pick_=pick_)
+
+    def _create_star_routing_embed_batched(self, graph, featureA, featureB, numA, numB, A_inshape, n_factors=4,
+                                           pick_=False):
+        '''
+        same routing as `_create_star_routing_embed_loop`, with the factors as a batch:
+        the factor-wise adjacencies are stacked into one block-diagonal [n_factors*numA, n_factors*numB]
+        matrix over the shared indices, so every direction is a single spmm and the degree
+        normalization is a broadcast multiply
+        '''
+        A_indices, A_indices_t, perm_t, _, _ = self._routing_index(graph)
+        all_h_list, all_t_list = A_indices
+        num_edges = A_indices.shape[1]
+        # indices of the block-diagonal matrices, factor f owns rows [f*numA, (f+1)*numA)
+        offset_A = (torch.arange(n_factors, device=A_indices.device) * numA).view(-1, 1)
+        offset_B = (torch.arange(n_factors, device=A_indices.device) * numB).view(-1, 1)
+        block_indices = torch.stack([(all_h_list + offset_A).view(-1), (all_t_list + offset_B).view(-1)])
+        block_indices_t = torch.stack([(A_indices_t[0] + offset_B).view(-1), (A_indices_t[1] + offset_A).view(-1)])
+        A_values = torch.ones(n_factors, num_edges, device=A_indices.device)
+
+        dim = int(featureA.shape[1] / n_factors)
+        all_A_embeddings = [featureA]
+        all_B_embeddings = [featureB]
+        for k in range(0, self.n_layers):
+            # [n_factors, numA, dim], [n_factors, numB, dim]
+            ego_A = featureA.reshape(numA, n_factors, dim).transpose(0, 1)
+            ego_B = featureB.reshape(numB, n_factors, dim).transpose(0, 1)
+            tail_factor_embedings = F.normalize(ego_B[:, all_t_list], dim=2)
+            for t in range(0, self.n_iterations):
+                A_factors, A_factors_t, D_col_factors, D_row_factors = self._convert_A_values_to_batched_factors(
+                    A_values, A_indices, perm_t, numA, numB, pick=False, graph=graph)
+
+                A_factor_embeddings = torch_sparse.spmm(
+                    block_indices, A_factors.view(-1), n_factors * numA, n_factors * numB,
+                    (D_row_factors.unsqueeze(2) * ego_B).reshape(n_factors * numB, dim))
+                A_iter_embeddings = ego_A + D_col_factors.unsqueeze(2) * A_factor_embeddings.view(n_factors, numA, dim)
+
+                B_factor_embeddings = torch_sparse.spmm(
+                    block_indices_t, A_factors_t.view(-1), n_factors * numB, n_factors * numA,
+                    (D_col_factors.unsqueeze(2) * ego_A).reshape(n_factors * numA, dim))
+                B_factor_embeddings = self._reduce_partition(B_factor_embeddings.view(n_factors, numB, dim), graph)
+                B_iter_embeddings = ego_B + D_row_factors.unsqueeze(2) * B_factor_embeddings.view(n_factors, numB, dim)
+
+                # attentive weights of every factor, [n_factors, all_h_list]
+                head_factor_embedings = F.normalize(A_iter_embeddings[:, all_h_list], dim=2)
+                A_iter_values = torch.sum(torch.mul(head_factor_embedings, F.tanh(tail_factor_embedings)), axis=2)
+                A_values = A_values + A_iter_values
+
+            featureA = A_iter_embeddings.transpose(0, 1).reshape(numA, n_factors * dim)
+            featureB = B_iter_embeddings.transpose(0, 1).reshape(numB, n_factors * dim)
+            all_A_embeddings = all_A_embeddings + [featureA]
+            all_B_embeddings = all_B_embeddings + [featureB]
+        all_A_embeddings = torch.stack(all_A_embeddings, 1)
+        all_A_embeddings = torch.mean(all_A_embeddings, dim=1, keepdims=False)
+        all_A_embeddings = self._gather_partition(graph, all_A_embeddings)
+        all_B_embeddings = torch.stack(all_B_embeddings, 1)
+        all_B_embeddings = torch.mean(all_B_embeddings, dim=1, keepdims=False)
+
+        return all_A_embeddings, all_B_embeddings, A_values
+
+    def _convert_A_values_to_batched_factors(self, A_factor_values, A_indices, perm_t, numA, numB, pick=False,
+                                             graph=None):
+        '''
+        batched `_convert_A_values_to_A_factors_with_P`, `graph`: name of the routing graph when partitioned
+        return A_factors, A_factors_t: [n_factors, all_h_list], D_col_factors: [n_factors, numA],
+        D_row_factors: [n_factors, numB]
+        '''
+        all_h_list, all_t_list = A_indices
+        if pick:
+            A_factor_scores = F.softmax(A_factor_values, 0)
+            min_A = torch.min(A_factor_scores, 0)
+            index = A_factor_scores > (min_A + 0.0000001)
+            index = index.type(torch.float32) * (
+                    self.pick_level - 1.0) + 1.0  # adjust the weight of the minimum factor to 1/self.pick_level
+
+            A_factor_scores = A_factor_scores * index
+            A_factor_scores = A_factor_scores / torch.sum(A_factor_scores, 0)
+        else:
+            A_factor_scores = F.softmax(A_factor_values, 0)
+        f_num = A_factor_scores.shape[0]
+        D_col_scores = A_factor_scores.new_zeros(f_num, numA).index_add_(1, all_h_list, A_factor_scores)
+        D_row_scores = A_factor_scores.new_zeros(f_num, numB).index_add_(1, all_t_list, A_factor_scores)
+        # B nodes may have edges on several ranks
+        D_row_scores = self._reduce_partition(D_row_scores, graph)
+        D_col_factors = 1 / (torch.sqrt(D_col_scores) + 1e-10)
+        D_row_factors = 1 / (torch.sqrt(D_row_scores) + 1e-10)
+        # same value order as torch_sparse.transpose, see `_register_routing_index`
+        A_factors_t = A_factor_scores[:, perm_t]
+        return A_factor_scores, A_factors_t, D_col_factors, D_row_factors
+
+    def _create_star_routing_embed_loop(self, graph, featureA, featureB, numA, numB, A_inshape, n_factors=4,
+                                        pick_=False):
+        '''
+        reference routing, one factor at a time
+        '''
         '''
         need parameter:
         n_factor
@@ -330,15 +715,14 @@ class MIDGN(Model):
         user_embedding --> bundle_feature
         item_embedding --> item_feature
         self.A_in_shape
-        A:all_h_list, all_t_list
+        A: graph ('ui' | 'bi'), see `_register_routing_index`
 
         '''
         p_test = False
         p_train = False
-        A_indices = torch.tensor([all_h_list, all_t_list], dtype=torch.long).to(self.device)
-        D_indices_col = torch.tensor([list(range(numA)), list(range(numA))]).to(self.device)
-        D_indices_row = torch.tensor([list(range(numB)), list(range(numB))]).to(self.device)
-        A_values = torch.ones(n_factors, len(all_h_list)).to(self.device)
+        A_indices, A_indices_t, perm_t, D_indices_col, D_indices_row = self._routing_index(graph)
+        all_h_list, all_t_list = A_indices
+        A_values = torch.ones(n_factors, A_indices.shape[1], device=A_indices.device)
         
         all_A_embeddings = [featureA]
         all_B_embeddings = [featureB]
@@ -375,10 +759,8 @@ class MIDGN(Model):
                 A_factors, A_factors_t, D_col_factors, D_row_factors = self._convert_A_values_to_A_factors_with_P(
                     n_factors_l,
                     A_values,
-                    all_h_list,
-                    all_t_list,
-                    numA,
-                    numB,
+                    A_indices,
+                    perm_t,
                     A_inshape,
                     pick=p_train)
                 for i in range(0, n_factors_l):
@@ -394,7 +776,7 @@ class MIDGN(Model):
 
                     B_factor_embeddings = torch_sparse.spmm(D_indices_col, D_col_factors[i], A_inshape[0], A_inshape[0],
                                                             ego_layer_A_embeddings[i])
-                    B_factor_embeddings = torch_sparse.spmm(A_indices[[1, 0]], A_factors_t[i], A_inshape[1],
+                    B_factor_embeddings = torch_sparse.spmm(A_indices_t, A_factors_t[i], A_inshape[1],
                                                             A_inshape[0],
                                                             B_factor_embeddings)  # torch.sparse.mm(A_factors[i], factor_embeddings)
 
@@ -449,17 +831,14 @@ class MIDGN(Model):
 
         return all_A_embeddings, all_B_embeddings, A_values
 
-    def _convert_A_values_to_A_factors_with_P(self, f_num, A_factor_values, all_h_list, all_t_list, numA, numB,
+    def _convert_A_values_to_A_factors_with_P(self, f_num, A_factor_values, A_indices, perm_t,
                                               A_inshape, pick=False):
         A_factors = []
         A_factors_t = []
         D_col_factors = []
         D_row_factors = []
-        all_h_list = torch.tensor(all_h_list, dtype=torch.long).to(self.device)
-        all_t_list = torch.tensor(all_t_list, dtype=torch.long).to(self.device)
         # get the indices of adjacency matrix
-
-        A_indices = torch.stack([all_h_list, all_t_list], dim=0)
+        all_h_list, all_t_list = A_indices
         # print(A_indices.shape)
         # apply factor-aware softmax function over the values of adjacency matrix
         # ....A_factor_values is [n_factors, all_h_list]
@@ -484,9 +863,10 @@ class MIDGN(Model):
                                       sparse_sizes=(A_inshape[0], A_inshape[1]))
             D_i_col_scores = 1 / (torch.sqrt(A_i_tensor.sum(dim=1)) + 1e-10)
             D_i_row_scores = 1 / (torch.sqrt(A_i_tensor.sum(dim=0)) + 1e-10)
-            _, A_i_scores_t = torch_sparse.transpose(A_indices, A_i_scores, A_inshape[0], A_inshape[1])
-            A_factors.append(A_i_scores.to(self.device))
-            A_factors_t.append(A_i_scores_t.to(self.device))
+            # == torch_sparse.transpose(A_indices, A_i_scores, ...)[1]
+            A_i_scores_t = A_i_scores[perm_t]
+            A_factors.append(A_i_scores)
+            A_factors_t.append(A_i_scores_t)
             D_col_factors.append(D_i_col_scores)
             D_row_factors.append(D_i_row_scores)
 
@@ -562,3 +942,21 @@ class MIDGN(Model):
         dcor = dcov_12 / (torch.sqrt(torch.maximum(dcov_11 * dcov_22, torch.tensor(0.0).to(self.device))) + 1e-10)
         # return tf.reduce_sum(D1) + tf.reduce_sum(D2)
         return dcor
+
+
+def load_MIDGN(session, device, checkpoint=None, info=None):
+    '''
+    `MIDGN` on the train graphs of `dataset.DatasetSession` `session`, initialized under the seed of `main.py`,
+    then with the weights of `checkpoint` if given
+    `info`: default, the evaluation setting (no dropout)
+    '''
+    graph = [session.bundle_train_data.ground_truth_u_b,
+             session.item_data.ground_truth_u_i,
+             session.assist_data.ground_truth_b_i]
+    if info is None:
+        info = MIDGN_Info(64, CONFIG['decays'][0], 0, 0, 2)
+    torch.manual_seed(123)
+    model = MIDGN(info, session.assist_data, graph, device).to(device)
+    if checkpoint is not None:
+        model.load_state_dict(torch.load(checkpoint, map_location=device))
+    return model
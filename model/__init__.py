@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-__all__ = ['MIDGN']
+__all__ = ['MIDGN', 'ItemBPR']
 
-from .MIDGN import MIDGN, MIDGN_Info
+from .MIDGN import MIDGN, MIDGN_Info, load_MIDGN
+from .ItemBPR import ItemBPR, ItemBPR_Info
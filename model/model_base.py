@@ -73,6 +73,8 @@ class Model(nn.Module):
         self.num_users = dataset.num_users
         self.num_bundles = dataset.num_bundles
         self.num_items = dataset.num_items
+        # optimizer steps taken, versions `snapshot.EmbeddingSnapshot`
+        self.train_steps = 0
         if create_embeddings:
             # embeddings
             self.users_feature = nn.Parameter(
@@ -103,8 +105,13 @@ class Model(nn.Module):
             ((users_feature ** 2).sum()+(bundles_feature**2).sum())
         return loss
 
-    def forward(self, users, bundles):
-        users_feature, bundles_feature = self.propagate()
+    def forward(self, users, bundles, propagate_result=None):
+        '''
+        `propagate_result`: output of `propagate` shared by several batches, None: propagate for this batch
+        '''
+        if propagate_result is None:
+            propagate_result = self.propagate()
+        users_feature, bundles_feature = propagate_result
         bundles_embedding = bundles_feature[bundles]
         users_embedding = users_feature[users].expand(
             -1, bundles.shape[1], -1)  
@@ -112,9 +119,10 @@ class Model(nn.Module):
         loss = self.regularize(users_embedding, bundles_embedding)
         return pred, loss
 
-    def evaluate(self, propagate_result, users):
+    def evaluate(self, propagate_result, users, bundles=None):
         '''
         just for testing, compute scores of all bundles for `users` by `propagate_result`
+        `bundles`: index or slice of the scored bundles, None: all
         '''
         raise NotImplementedError
 
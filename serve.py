@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import asyncio
+from collections import deque
+from time import time
+from urllib.parse import urlsplit, parse_qs
+import torch
+import numpy as np
+from ann import fuse_views
+from export import EmbeddingStore
+from config import CONFIG
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           414: 'URI Too Long', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+MAX_LINE = 8192  # bytes of the request line and of every header line
+MAX_HEADERS = 100
+MAX_BODY = 65536
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Stats(object):
+    '''
+    latency percentiles and throughput over the last `window` answered requests
+    '''
+
+    def __init__(self, window=10000):
+        self.start = time()
+        self.finished = deque(maxlen=window)  # (finish time, latency)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+
+    def record(self, latency):
+        self.requests += 1
+        self.finished.append((time(), latency))
+
+    def record_batch(self, size):
+        self.batches += 1
+        self.batched += size
+
+    def report(self):
+        report = {'uptime_s': time() - self.start,
+                  'requests': self.requests,
+                  'errors': self.errors,
+                  'batches': self.batches,
+                  'mean_batch': self.batched / max(self.batches, 1)}
+        if len(self.finished) > 1:
+            ends, latencies = zip(*self.finished)
+            p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+            report.update(p50_ms=p50, p99_ms=p99, throughput_rps=(len(ends) - 1) / max(ends[-1] - ends[0], 1e-9))
+        return report
+
+
+class Recommender(object):
+    '''
+    top-K bundles of users from an `export.EmbeddingStore`, with their train interactions excluded
+    the requests queued within `max_wait` seconds of the first queued one, including those that
+    arrive while a batch is scored, are answered together by one GEMM and one topk, at most
+    `max_batch` at a time
+    '''
+
+    def __init__(self, store, device, max_batch, max_wait):
+        self.store = store
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.users_vector = torch.from_numpy(fuse_views(store.users_feature)).to(device)
+        self.bundles_vector = torch.from_numpy(fuse_views(store.bundles_feature)).to(device)
+        self.indptr = torch.from_numpy(np.array(store.arrays['train_indptr'], dtype=np.int64))
+        self.indices = torch.from_numpy(np.array(store.arrays['train_indices'], dtype=np.int64))
+        self.stats = Stats()
+        self.queue = None
+
+    def topk(self, users, topk):
+        '''
+        (scores, bundles) [len(`users`), `topk`] of the user indices `users`, best first,
+        scores are -inf past the bundles a user has not trained on
+        '''
+        users = torch.tensor(users, dtype=torch.long)
+        start, num_train = self.indptr[users], self.indptr[users + 1] - self.indptr[users]
+        # train bundles of the batch as (row, col)
+        row = torch.repeat_interleave(torch.arange(users.shape[0]), num_train)
+        offset = torch.arange(row.shape[0]) - (num_train.cumsum(0) - num_train)[row] + start[row]
+        col = self.indices[offset]
+        with torch.no_grad():
+            scores = self.users_vector[users.to(self.device)] @ self.bundles_vector.t()  # batch_b
+            scores[row.to(self.device), col.to(self.device)] = -float('inf')
+            scores, bundles = torch.topk(scores, topk)
+        return scores.cpu(), bundles.cpu()
+
+    async def recommend(self, user, topk):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        await self.queue.put((user, topk, future, loop.time()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        while True:
+            batch = [await self.queue.get()]
+            # wait for more only until `max_wait` after the first request was queued, and not once the batch is full
+            deadline = batch[0][3] + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                scores, bundles = await loop.run_in_executor(
+                    None, self.topk, [user for user, _, _, _ in batch], max(topk for _, topk, _, _ in batch))
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.record_batch(len(batch))
+            for i, (_, topk, future, _) in enumerate(batch):
+                if not future.done():
+                    # a user with fewer than `topk` untrained bundles gets fewer results, not -inf scores
+                    found = scores[i, :topk] > -float('inf')
+                    future.set_result((scores[i, :topk][found].tolist(), bundles[i, :topk][found].tolist()))
+
+
+class Server(object):
+    '''
+    HTTP/1.1 with keep-alive on asyncio streams
+    - GET /recommend?user=<raw user id>&k=<K>: {"user", "bundles": raw bundle ids, "scores"}
+    - GET /metrics: `Stats.report`
+    '''
+
+    def __init__(self, recommender):
+        self.recommender = recommender
+        self.store = recommender.store
+
+    async def route(self, method, target):
+        url = urlsplit(target)
+        if url.path == '/metrics':
+            return 200, self.recommender.stats.report()
+        if url.path != '/recommend':
+            return 404, {'error': 'unknown path {}'.format(url.path)}
+        if method != 'GET':
+            return 405, {'error': 'use GET'}
+        query = parse_qs(url.query)
+        if 'user' not in query:
+            return 400, {'error': 'missing user'}
+        raw = query['user'][0]
+        try:
+            topk = int(query.get('k', ['20'])[0])
+            user = self.store.index('user', raw)
+        except ValueError:
+            return 400, {'error': 'bad user or k'}
+        except KeyError:
+            return 404, {'error': 'unknown user {}'.format(raw)}
+        if not 0 <= user < self.store.num_users:
+            return 404, {'error': 'unknown user {}'.format(raw)}
+        if not 0 < topk <= self.store.num_bundles:
+            return 400, {'error': 'k out of [1, {}]'.format(self.store.num_bundles)}
+        start = time()
+        scores, bundles = await self.recommender.recommend(user, topk)
+        self.recommender.stats.record(time() - start)
+        return 200, {'user': raw,
+                     'bundles': [self.store.raw_id('bundle', b) for b in bundles],
+                     'scores': scores}
+
+    async def read_head(self, reader):
+        '''
+        (request line, headers) of the next request with its body skipped, None at the end of the stream
+        raises `HTTPError` past `MAX_LINE`, `MAX_HEADERS` or `MAX_BODY`, the stream reader of
+        `serve` is limited to `MAX_LINE` bytes a line
+        '''
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise HTTPError(414, 'request line over {} bytes'.format(MAX_LINE))
+        if not line:
+            return None
+        headers = {}
+        while True:
+            try:
+                header = await reader.readline()
+            except ValueError:
+                raise HTTPError(431, 'header over {} bytes'.format(MAX_LINE))
+            if header in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPError(431, 'over {} headers'.format(MAX_HEADERS))
+            name, _, value = header.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, 'bad content-length')
+        if not 0 <= length <= MAX_BODY:
+            raise HTTPError(413, 'body over {} bytes'.format(MAX_BODY))
+        if length > 0:
+            await reader.readexactly(length)
+        return line, headers
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await self.read_head(reader)
+                except HTTPError as e:
+                    # the rest of the stream cannot be framed, answer and close
+                    self.recommender.stats.errors += 1
+                    self.respond(writer, e.status, {'error': str(e)}, False)
+                    await writer.drain()
+                    break
+                if head is None:
+                    break
+                line, headers = head
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                    status, body = await self.route(method, target)
+                except ValueError:
+                    method, target, version = None, None, 'HTTP/1.0'
+                    status, body = 400, {'error': 'bad request line'}
+                except Exception as e:
+                    status, body = 500, {'error': str(e)}
+                if status != 200:
+                    self.recommender.stats.errors += 1
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                self.respond(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, body, keep_alive):
+        body = json.dumps(body).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: {}\r\n\r\n'.format(status, REASONS[status], len(body),
+                                                     'keep-alive' if keep_alive else 'close').encode()
+                     + body)
+
+
+async def serve(recommender, host, port):
+    batcher = asyncio.ensure_future(recommender.run())
+    server = await asyncio.start_server(Server(recommender).handle, host, port, limit=MAX_LINE)
+    print('serving {} on http://{}:{}'.format(recommender.store.path, host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+
+def main():
+    '''
+    python serve.py [version]: serve the embedding store of `CONFIG['dataset_name']` (see export.py),
+    its latest version by default, on `CONFIG['serve_host']`:`CONFIG['serve_port']`
+    '''
+    os.environ["CUDA_VISIBLE_DEVICES"] = CONFIG['gpu_id']
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    store = EmbeddingStore(os.path.join(CONFIG['export'], CONFIG['dataset_name']),
+                           sys.argv[1] if len(sys.argv) > 1 else None)
+    recommender = Recommender(store, device, CONFIG['serve_max_batch'], CONFIG['serve_max_wait'] / 1000)
+    asyncio.run(serve(recommender, CONFIG['serve_host'], CONFIG['serve_port']))
+
+
+if __name__ == "__main__":
+    main()
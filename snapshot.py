@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import torch
+
+
+class EmbeddingSnapshot(object):
+    '''
+    the `propagate` result of `model` for its weights after `model.train_steps` optimizer steps,
+    computed once (eval mode, no_grad) and shared by the eval/test loaders, checkpointing and export
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.step = None
+        self._result = None
+
+    def get(self):
+        '''
+        the `propagate` result, recomputed only if the model took optimizer steps since the last call
+        '''
+        if self._result is None or self.step != self.model.train_steps:
+            training = self.model.training
+            self.model.eval()
+            with torch.no_grad():
+                self._result = self.model.propagate()
+            self.model.train(training)
+            self.step = self.model.train_steps
+        return self._result
+
+    def state_dict(self):
+        '''
+        `step` and the user/bundle embeddings of `propagate` (a tensor, or a list of one tensor per view) on CPU
+        '''
+        users_feature, bundles_feature = self.get()[:2]
+        to_cpu = lambda f: [i.cpu() for i in f] if isinstance(f, (list, tuple)) else f.cpu()
+        return {'step': self.step,
+                'users_feature': to_cpu(users_feature),
+                'bundles_feature': to_cpu(bundles_feature)}
+
+
+class SnapshotScorer(object):
+    '''
+    stands in for the model in `test.test` with the user/bundle embeddings of `EmbeddingSnapshot.state_dict`,
+    the score of a user and a bundle is the sum over the views of the dot products
+    '''
+
+    def __init__(self, users_feature, bundles_feature, device):
+        views = lambda f: [i.to(device) for i in f] if isinstance(f, (list, tuple)) else [f.to(device)]
+        self.users_feature = views(users_feature)
+        self.bundles_feature = views(bundles_feature)
+        self.num_bundles = self.bundles_feature[0].shape[0]
+
+    def eval(self):
+        return self
+
+    def propagate(self):
+        return self.users_feature, self.bundles_feature, None, None, None
+
+    def evaluate(self, propagate_result, users, bundles=None):
+        users_feature, bundles_feature = propagate_result[:2]
+        if bundles is not None:
+            bundles_feature = [i[bundles] for i in bundles_feature]
+        return sum(torch.mm(u[users], b.t()) for u, b in zip(users_feature, bundles_feature))  # batch_b
+
+    def __call__(self, users, bundles, propagate_result):
+        users_feature, bundles_feature = propagate_result[:2]
+        pred = sum(torch.sum(u[users] * b[bundles], 2) for u, b in zip(users_feature, bundles_feature))  # batch_n
+        return pred, 0, 0
@@ -8,29 +8,104 @@ import torch.optim as optim
 from torch.utils.data import DataLoader
 from time import time
 import os
+from metric import MetricEngine
 
-def test(model, loader, device, CONFIG, metrics, test=True):
+def csr_nonzeros(indptr, indices, device):
+    '''
+    nonzeros of a CSR slice as (row, column) LongTensors on `device`, and the row lengths
+    '''
+    indptr, col = indptr.to(device), indices.to(device)
+    num_nonzeros = indptr[1:] - indptr[:-1]
+    row = torch.repeat_interleave(torch.arange(num_nonzeros.shape[0], device=device), num_nonzeros)
+    return row, col, num_nonzeros
+
+
+def topk_bundles(model, propagate_result, users, train_row, train_col, topk, block):
+    '''
+    top `topk` bundles of `users`, best first, with their train interactions (`train_row`, `train_col`) excluded.
+    bundles are scored `block` at a time against a running top-k, so only batch x (`block` + `topk`)
+    scores are alive however many bundles there are
+    '''
+    num_bundles = model.num_bundles
+    top_scores = top_bundles = None
+    for start in range(0, num_bundles, block):
+        end = min(start + block, num_bundles)
+        scores = model.evaluate(propagate_result, users, slice(start, end))  # batch_block
+        seen = (train_col >= start) & (train_col < end)
+        scores[train_row[seen], train_col[seen] - start] = -float('inf')
+        bundles = torch.arange(start, end, device=scores.device).expand_as(scores)
+        if top_scores is not None:
+            scores = torch.cat([top_scores, scores], dim=1)
+            bundles = torch.cat([top_bundles, bundles], dim=1)
+        top_scores, col = torch.topk(scores, min(topk, scores.shape[1]))
+        top_bundles = bundles.gather(1, col)
+    return top_bundles
+
+
+def get_csr_is_hit(top_bundles, ground_truth_row, ground_truth_col, num_bundles):
+    '''
+    float [batch, k], whether `top_bundles` are nonzeros (`ground_truth_row`, `ground_truth_col`) of the ground truth
+    '''
+    if ground_truth_col.shape[0] == 0:
+        return torch.zeros(top_bundles.shape, device=top_bundles.device)
+    keys, _ = torch.sort(ground_truth_row * num_bundles + ground_truth_col)
+    query = torch.arange(top_bundles.shape[0], device=top_bundles.device).view(-1, 1) * num_bundles + top_bundles
+    found = torch.searchsorted(keys, query).clamp(max=keys.shape[0] - 1)
+    return (keys[found] == query).float()
+
+
+def get_sampled_is_hit(model, propagate_result, users, ground_truth_row, ground_truth_col, num_pos, negatives, topk):
+    '''
+    float [batch, k]: the positives (`ground_truth_row`, `ground_truth_col`) of `users` ranked against
+    their sampled `negatives` [batch, N] only
+    '''
+    device = negatives.device
+    width = int(num_pos.max())
+    # positives left-aligned in [batch, width], the padding of users with fewer positives scores -inf
+    slot = torch.arange(ground_truth_col.shape[0], device=device) - (num_pos.cumsum(0) - num_pos)[ground_truth_row]
+    positives = torch.zeros(negatives.shape[0], width, dtype=torch.long, device=device)
+    positives[ground_truth_row, slot] = ground_truth_col
+    scores, _, _ = model(users.view(-1, 1), torch.cat([positives, negatives], dim=1), propagate_result)
+    padding = torch.arange(width, device=device).view(1, -1) >= num_pos.view(-1, 1)
+    scores[:, :width].masked_fill_(padding, -float('inf'))
+    _, col = torch.topk(scores, min(topk, scores.shape[1]))
+    return (col < num_pos.view(-1, 1)).float()
+
+
+def test(model, loader, device, CONFIG, metrics, test=True, snapshot=None, sampled=None):
     '''
     test for dot-based model
+    `snapshot`: `snapshot.EmbeddingSnapshot` of `model`, shared by several calls at the same weights
+    `sampled`: rank the positives against this many fixed negatives of `BundleTestDataset.sampled_negatives`, None: all bundles
     '''
     model.eval()
-    for metric in metrics:
-        metric.start()
+    engine = MetricEngine(metrics)
+    engine.start()
     start = time()
+    if sampled is not None:
+        negatives = loader.dataset.sampled_negatives(sampled).to(device)
+        positions = torch.from_numpy(loader.dataset.users).to(device)
     with torch.no_grad():
-        rs = model.propagate() 
+        rs = model.propagate() if snapshot is None else snapshot.get()
         for users, ground_truth_u_b, train_mask_u_b in loader:
-            pred_b = model.evaluate(rs, users.to(device))  
-            pred_b -= 1e8*train_mask_u_b.to(device)
-            for metric in metrics:
-                metric(pred_b, ground_truth_u_b.to(device))
+            users = users.to(device)
+            ground_truth_row, ground_truth_col, num_pos = csr_nonzeros(*ground_truth_u_b, device)
+            if sampled is not None:
+                is_hit = get_sampled_is_hit(model, rs, users, ground_truth_row, ground_truth_col, num_pos,
+                                            negatives[torch.searchsorted(positions, users)], engine.topk)
+            else:
+                train_row, train_col, _ = csr_nonzeros(*train_mask_u_b, device)
+                top_bundles = topk_bundles(model, rs, users, train_row, train_col, engine.topk, CONFIG['eval_block'])
+                is_hit = get_csr_is_hit(top_bundles, ground_truth_row, ground_truth_col, model.num_bundles)
+            engine(is_hit, num_pos)
     if test:
         print('Test: time={:d}s'.format(int(time()-start)))
     else:
-        print('Eval: time={:d}s'.format(int(time()-start)))
+        print('Eval{}: time={:d}s'.format('' if sampled is None else ' ({} sampled)'.format(sampled),
+                                          int(time()-start)))
         
+    engine.stop()
     for metric in metrics:
-        metric.stop()
         print('{}:{}'.format(metric.get_title(), metric.metric), end='\t')
     print('')
     return metrics
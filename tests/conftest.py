@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+
+# the modules of the repo are imported top-level, as by the scripts in its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def random_graph(shape, density, seed):
+    '''
+    random binary csr_matrix of `shape`, every row and column has at least one edge
+    '''
+    rng = np.random.RandomState(seed)
+    graph = sp.random(*shape, density=density, format='csr', random_state=rng)
+    cover = np.arange(max(shape))
+    graph = graph + sp.csr_matrix((np.ones(len(cover)), (cover % shape[0], cover % shape[1])), shape=shape)
+    graph.data[:] = 1
+    return graph.astype(np.float32).tocsr()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import torch
+from ann import IVFIndex
+from conftest import random_graph
+from test import csr_nonzeros
+
+NUM_QUERIES, NUM_ROWS, NLIST, TOPK = 20, 200, 8, 10
+
+
+def test_full_probe_is_exact():
+    rng = np.random.RandomState(0)
+    vectors = rng.randn(NUM_ROWS, 16).astype(np.float32)
+    queries = torch.from_numpy(rng.randn(NUM_QUERIES, 16).astype(np.float32))
+    index = IVFIndex(vectors, NLIST)
+    # every row in exactly one list
+    assert torch.equal(torch.sort(index.ids)[0], torch.arange(NUM_ROWS))
+    assert index.offsets[-1].item() == NUM_ROWS
+
+    exclude = random_graph((NUM_QUERIES, NUM_ROWS), 0.05, 1)
+    row, col, _ = csr_nonzeros(torch.from_numpy(exclude.indptr.astype(np.int64)),
+                               torch.from_numpy(exclude.indices.astype(np.int64)), 'cpu')
+    exact = queries @ torch.from_numpy(vectors).t()
+    for pairs in (None, (row, col)):
+        if pairs is not None:
+            exact[row, col] = -float('inf')
+        scores, ids = index.search(queries, TOPK, NLIST, exclude=pairs, chunk=6)
+        expected_scores, expected_ids = torch.topk(exact, TOPK)
+        assert torch.equal(ids, expected_ids)
+        assert torch.allclose(scores, expected_scores, atol=1e-5)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import torch
+from conftest import random_graph
+from metric import MetricEngine, Recall, Precision, NDCG, MRR
+from snapshot import SnapshotScorer
+from test import csr_nonzeros, topk_bundles, get_csr_is_hit
+
+NUM_USERS, NUM_BUNDLES, TOPK = 16, 40, 10
+
+
+def csr_batch(graph):
+    return torch.from_numpy(graph.indptr.astype(np.int64)), torch.from_numpy(graph.indices.astype(np.int64))
+
+
+def reference(scores, train, ground_truth, topk):
+    '''
+    Recall, Precision, NDCG and MRR @`topk` of every user from a full sort of the dense `scores`
+    '''
+    scores = np.where(train.toarray() > 0, -np.inf, scores)
+    ground_truth = ground_truth.toarray() > 0
+    values = []
+    for row, positives in zip(np.argsort(-scores, axis=1)[:, :topk], ground_truth):
+        if not positives.any():
+            continue
+        hit = positives[row]
+        num_pos = positives.sum()
+        discount = 1 / np.log2(np.arange(2, topk + 2))
+        first = np.argmax(hit) if hit.any() else None
+        values.append([hit.sum() / num_pos, hit.sum() / topk,
+                       (hit * discount).sum() / discount[:min(num_pos, topk)].sum(),
+                       0 if first is None else 1 / (first + 1)])
+    return np.mean(values, axis=0)
+
+
+def test_streaming_metrics_match_dense():
+    torch.manual_seed(0)
+    scorer = SnapshotScorer([torch.randn(NUM_USERS, 8), torch.randn(NUM_USERS, 8)],
+                            [torch.randn(NUM_BUNDLES, 8), torch.randn(NUM_BUNDLES, 8)], torch.device('cpu'))
+    rs = scorer.propagate()
+    users = torch.arange(NUM_USERS)
+    train = random_graph((NUM_USERS, NUM_BUNDLES), 0.1, 1)
+    ground_truth = random_graph((NUM_USERS, NUM_BUNDLES), 0.1, 2)
+    ground_truth = (ground_truth - ground_truth.multiply(train)).tocsr()
+    ground_truth.eliminate_zeros()
+    train_row, train_col, _ = csr_nonzeros(*csr_batch(train), 'cpu')
+    ground_truth_row, ground_truth_col, num_pos = csr_nonzeros(*csr_batch(ground_truth), 'cpu')
+
+    # the running top-K over blocks is the top-K of the dense scores
+    dense = scorer.evaluate(rs, users)
+    dense[train_row, train_col] = -float('inf')
+    top_bundles = topk_bundles(scorer, rs, users, train_row, train_col, TOPK, block=7)
+    assert torch.equal(top_bundles, torch.topk(dense, TOPK)[1])
+
+    # every metric and K from one ranking
+    for topk in (5, TOPK):
+        metrics = [Recall(topk), Precision(topk), NDCG(topk), MRR(topk)]
+        engine = MetricEngine(metrics + [Recall(TOPK)])
+        engine.start()
+        engine(get_csr_is_hit(top_bundles, ground_truth_row, ground_truth_col, NUM_BUNDLES), num_pos)
+        engine.stop()
+        expected = reference(dense.numpy(), train, ground_truth, topk)
+        assert np.allclose([metric.metric for metric in metrics], expected, atol=1e-6)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+import pytest
+import torch
+from conftest import random_graph
+
+torch_sparse = pytest.importorskip('torch_sparse')
+from model import MIDGN, MIDGN_Info
+from model.MIDGN import routing_index
+
+NUM_USERS, NUM_BUNDLES, NUM_ITEMS = 12, 8, 15
+
+
+def tiny_model():
+    graph = [random_graph((NUM_USERS, NUM_BUNDLES), 0.2, 1),
+             random_graph((NUM_USERS, NUM_ITEMS), 0.2, 2),
+             random_graph((NUM_BUNDLES, NUM_ITEMS), 0.3, 3)]
+    sizes = SimpleNamespace(num_users=NUM_USERS, num_bundles=NUM_BUNDLES, num_items=NUM_ITEMS)
+    torch.manual_seed(123)
+    return MIDGN(MIDGN_Info(16, 1e-4, 0, 0, 2), sizes, graph, torch.device('cpu')).eval()
+
+
+def run(model, routing):
+    '''
+    propagate outputs and gradients of the parameters under the `routing` engine
+    '''
+    model.routing = routing
+    params = [p for p in model.parameters() if p.requires_grad]
+    users_feature, bundles_feature, _, _, _ = model.propagate()
+    outputs = users_feature + bundles_feature
+    grads = torch.autograd.grad(sum((o ** 2).sum() for o in outputs), params, allow_unused=True)
+    return [o.detach() for o in outputs], [g for g in grads if g is not None]
+
+
+def test_transpose_pairing():
+    graph = random_graph((NUM_BUNDLES, NUM_ITEMS), 0.3, 3)
+    indices, indices_t, perm_t, _, _ = routing_index(graph)
+    values = torch.rand(indices.shape[1])
+    A = torch.sparse_coo_tensor(indices, values, graph.shape).to_dense()
+    A_t = torch.sparse_coo_tensor(indices_t, values[perm_t], graph.shape[::-1]).to_dense()
+    assert torch.equal(A_t, A.t())
+    index, value = torch_sparse.transpose(indices, values, *graph.shape)
+    assert torch.equal(index, indices_t)
+    assert torch.equal(value, values[perm_t])
+
+
+def test_batched_matches_loop():
+    model = tiny_model()
+    loop_out, loop_grads = run(model, 'loop')
+    batched_out, batched_grads = run(model, 'batched')
+    assert len(loop_grads) == len(batched_grads)
+    for a, b in zip(loop_out + loop_grads, batched_out + batched_grads):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-5)
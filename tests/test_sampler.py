@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse as sp
+from conftest import random_graph
+from dataset import PositiveIndex, sample_negatives, build_hard_candidates, AliasTable
+
+
+def test_positive_index():
+    graph = random_graph((20, 30), 0.2, 0)
+    rows, cols = np.meshgrid(np.arange(20), np.arange(30), indexing='ij')
+    assert np.array_equal(PositiveIndex(graph).contains(rows.ravel(), cols.ravel()), graph.toarray().ravel() != 0)
+
+
+def test_sample_negatives():
+    graph = random_graph((20, 30), 0.3, 0)
+    rows = np.repeat(np.arange(20), 5)
+    uniform = lambda idx: np.random.randint(30, size=idx.shape[0])
+    np.random.seed(0)
+    negs = sample_negatives(PositiveIndex(graph), rows, 4, uniform)
+    assert negs.shape == (100, 4)
+    # never a positive of the row, never twice in a row
+    assert not graph[rows[:, None], negs].toarray().any()
+    assert all(len(set(neg)) == 4 for neg in negs)
+
+
+def test_hard_candidates():
+    rng = np.random.RandomState(0)
+    A = sp.random(25, 40, density=0.3, format='csr', random_state=rng)
+    B = sp.random(30, 40, density=0.3, format='csr', random_state=rng)
+    window = (0.5, 0.8)
+    lo, hi = [int(i * 30) for i in window]
+    scores = (A @ B.T).toarray()
+    for processes in (1, 2):
+        candidates = build_hard_candidates(A, B, window, processes)
+        assert candidates.width == hi - lo
+        for row in range(25):
+            expected = np.argsort(scores[row], kind='stable')[lo:hi]
+            expected = expected[scores[row, expected] > 0]
+            stored = candidates.indices[candidates.indptr[row]:candidates.indptr[row + 1]]
+            assert set(stored.tolist()) == set(expected.tolist())
+
+
+def implied_distribution(table):
+    n = table.prob.shape[0]
+    p = table.prob / n
+    np.add.at(p, table.alias, (1 - table.prob) / n)
+    return p
+
+
+def test_alias_table():
+    rng = np.random.RandomState(0)
+    for weights in (rng.rand(50), rng.rand(300) ** 8, np.r_[1e6, np.ones(1000)], np.array([0, 0, 3.])):
+        table = AliasTable(weights)
+        assert np.allclose(implied_distribution(table), weights / weights.sum())
+        assert (table.prob >= 0).all() and (table.prob <= 1).all()
+    # no weight at all: uniform
+    assert np.allclose(implied_distribution(AliasTable(np.zeros(7))), np.full(7, 1 / 7))
+    draws = AliasTable(np.array([0, 1., 0, 3.])).draw(1000)
+    assert set(draws.tolist()) <= {1, 3}
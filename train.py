@@ -7,22 +7,71 @@ import torch.optim as optim
 from torch.utils.data import DataLoader
 from time import time
 import os
+from distributed import all_reduce_gradients, is_master
+
+class MultiOptimizer(object):
+    '''
+    several optimizers over disjoint parameter groups stepped together, e.g. `SparseAdam` + `Adam`
+    '''
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for op in self.optimizers:
+            op.zero_grad()
+
+    def step(self):
+        for op in self.optimizers:
+            op.step()
+
+    def state_dict(self):
+        return [op.state_dict() for op in self.optimizers]
+
+    def load_state_dict(self, state):
+        for op, op_state in zip(self.optimizers, state):
+            op.load_state_dict(op_state)
+
+    def __repr__(self):
+        return 'MultiOptimizer ({})'.format(', '.join(str(op).split(' ')[0] for op in self.optimizers))
 
 def train(model, epoch, loader, optim, device, CONFIG, loss_func):
+    '''
+    one propagation serves `CONFIG['propagate_every']` batches: their losses are averaged and
+    backpropagated once through the shared graph, followed by one optimizer step
+    '''
     log_interval = CONFIG['log_interval']
+    batch_size = CONFIG['batch_size_train']
+    propagate_every = CONFIG.get('propagate_every', 1)
     model.train()
     start = time()
+    num_pairs = 0
+    num_steps = 0
+    group_loss = []
     for i, data in enumerate(loader):
         users_b, bundles = data
-        modelout = model(users_b.to(device), bundles.to(device))
-        loss = loss_func(modelout, batch_size=loader.batch_size)
-        optim.zero_grad()
-        loss.backward()
-        optim.step()
-        if i % log_interval == 0:
+        if not group_loss:
+            propagate_result = model.propagate() if propagate_every > 1 else None
+        modelout = model(users_b.to(device), bundles.to(device), propagate_result)
+        loss = loss_func(modelout, batch_size=batch_size)
+        group_loss.append(loss)
+        num_pairs += users_b.shape[0]
+        if len(group_loss) == propagate_every or i == len(loader) - 1:
+            loss = sum(group_loss) / len(group_loss)
+            optim.zero_grad()
+            loss.backward()
+            all_reduce_gradients(model)
+            optim.step()
+            model.train_steps += 1
+            group_loss = []
+            propagate_result = None
+            num_steps += 1
+        if i % log_interval == 0 and is_master():
             print('U-B Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                epoch, (i+1) * loader.batch_size, len(loader.dataset),
+                epoch, (i+1) * batch_size, len(loader.dataset),
                 100. * (i+1) / len(loader), loss))
-    print('Train Epoch: {}: time = {:d}s'.format(epoch, int(time()-start)))
+    cost = time() - start
+    if is_master():
+        print('Train Epoch: {}: time = {:d}s, {:.0f} pairs/s, {} propagations/steps for {} batches'.format(
+            epoch, int(cost), num_pairs / cost, num_steps, len(loader)))
     return loss
 
@@ -97,7 +97,18 @@ class Logger(object):
         self.cnt += 1
         self._metrics_log = None
 
-    def update_log(self, metrics, model):
+    def save_checkpoint(self, model, model_path, sampler=None, snapshot=None):
+        '''
+        save `model`, the `state_dict` of `sampler` (e.g. `dataset.EpochNegativeTable`) to `model_path`.sampler
+        and the embeddings of `snapshot` (`snapshot.EmbeddingSnapshot`) to `model_path`.emb
+        '''
+        torch.save(model.state_dict(), model_path)
+        if sampler is not None:
+            torch.save(sampler.state_dict(), model_path + '.sampler')
+        if snapshot is not None:
+            torch.save(snapshot.state_dict(), model_path + '.emb')
+
+    def update_log(self, metrics, model, sampler=None, snapshot=None):
         # save metrics
         if self._metrics_log is None:
             self._metrics_log = {
@@ -114,13 +125,13 @@ class Logger(object):
             if self.checkpoint_epoch % self.checkpoint_interval == 0:
                 model_path = os.path.join(
                     self.root_path, '{}.pth'.format(self.get_model_Id(self.modelinfo)))
-                torch.save(model.state_dict(), model_path)
+                self.save_checkpoint(model, model_path, sampler, snapshot)
         elif self.checkpoint_policy == 'best':
             for target in self.checkpoint_target:
                 if self.metrics_log[target][-1] == max(self.metrics_log[target]):
                     model_path = os.path.join(self.root_path, '{}_{}.pth'.format(
                         self.get_model_Id(self.modelinfo), target))
-                    torch.save(model.state_dict(), model_path)
+                    self.save_checkpoint(model, model_path, sampler, snapshot)
 
     def close_log(self, target, window_size=10):
         self.csv_log.write('{}, {}, '.format(